@@ -0,0 +1,217 @@
+import argparse
+import contextlib
+import io
+import json
+import random
+import sys
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+# The modules import each other from the project root and from functionApproximation
+PROJECT_PATH = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(PROJECT_PATH), str(PROJECT_PATH / 'functionApproximation')]
+
+from booleanMultiplexer import firstLayerMultiplexer
+from booleanMultiplexer.gpBooleanMultiplexerInitialization import GpFirstLayerMUXInitializer, \
+    GpSecondLayerInitializer as GpSecondLayerMUXInitializer
+from booleanMultiplexer.muxCustomLogic import BitParallelTruthTable, generate_all_possible_input_combinations, \
+    generate_all_input_combinations_for_model
+from booleanMultiplexer.secondLayerMultiplexer import SecondLayerMultiplexer
+from booleanMultiplexer.singleLayer import simpleMultiplexer
+from customLogic import koza_custom_two_point_crossover, trim_individual, get_individual_height, \
+    koza_over_selection, gp_evolution, evaluate_individuals
+from functionApproximation import firstLayer
+from functionApproximation.gpInitialization import GpFirstLayerInitializer, GpSecondLayerInitializer, X_RANGE, \
+    Y_RANGE, get_grid_values
+from functionApproximation.secondLayer import SecondLayer
+from functionApproximation.singleLayer import simpleGp
+from runScheduler import CsvExportRecorder
+from vectorizedEvaluation import compute_output_vector
+
+BENCHMARK_SEED = 42
+REFERENCE_POPULATION_SIZE = 200
+SLOW_EVALUATOR_POPULATION_SIZE = 20  # the per-point and per-case evaluators only get a part of the population
+REPEATS = 5  # every benchmark is repeated and the fastest repetition is kept
+TRIM_HEIGHT = 4  # below the initial tree height, so the trimming benchmark actually cuts trees
+KOZA_OVER_SELECTION_POPULATION_SIZE = 1000  # the fittest group of Koza's over-selection holds 32% of the fitness
+END_TO_END_POPULATION_SIZE = 100
+END_TO_END_GENERATIONS = 5
+END_TO_END_SUB_MODELS = 4
+MUX_ADDRESSES_TO_APPROXIMATE = 4
+REGRESSION_TOLERANCE = 0.2  # a rate more than 20% below the baseline is reported as a regression
+BASELINE_PATH = Path(__file__).resolve().parent / 'baseline.json'
+
+
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def measure(benchmark, number_of_operations):
+    # Returns the number of operations per second of the fastest repetition, every repetition starts from the seed
+    fastest_time = float('inf')
+    for _ in range(REPEATS):
+        seed_everything(BENCHMARK_SEED)
+        with contextlib.redirect_stdout(io.StringIO()):  # gp_evolution prints every generation
+            start = time.perf_counter()
+            benchmark()
+            fastest_time = min(fastest_time, time.perf_counter() - start)
+    return number_of_operations / fastest_time
+
+
+def get_reference_population(toolbox, size):
+    seed_everything(BENCHMARK_SEED)
+    return toolbox.population(n=size)
+
+
+def benchmark_operators(results, prefix, pset, population):
+    pairs = list(zip(population[::2], population[1::2]))
+    results[prefix + 'crossover_per_second'] = measure(
+        lambda: [koza_custom_two_point_crossover(parent1, parent2) for parent1, parent2 in pairs], len(pairs))
+    csv_export_recorder = CsvExportRecorder()
+    results[prefix + 'trim_per_second'] = measure(
+        lambda: [trim_individual(individual, TRIM_HEIGHT, pset, csv_export_recorder) for individual in population],
+        len(population))
+    csv_export_recorder.take_calls()
+    results[prefix + 'height_per_second'] = measure(
+        lambda: [get_individual_height(individual) for individual in population], len(population))
+
+
+def benchmark_approximation(results):
+    initializer = GpFirstLayerInitializer()
+    initializer.initialize_gp_run()
+    x_grid, y_grid = np.meshgrid(X_RANGE, Y_RANGE)
+    grid_points = np.column_stack((x_grid.flatten(), y_grid.flatten()))
+    seed_everything(BENCHMARK_SEED)
+    first_layer = firstLayer.FirstLayer(initializer.pset, grid_points, CsvExportRecorder())
+    first_layer.initialize_toolbox()
+    population = get_reference_population(first_layer.toolbox, REFERENCE_POPULATION_SIZE)
+
+    slow_population = population[:SLOW_EVALUATOR_POPULATION_SIZE]
+    results['approximation_evaluate_mse_per_second'] = measure(
+        lambda: [first_layer.evaluate_individual_mse(individual) for individual in slow_population],
+        len(slow_population))
+
+    def evaluate_vectorized():
+        if first_layer.subtree_cache is not None:
+            first_layer.subtree_cache.clear()
+        for individual in population:
+            first_layer.evaluate_individual_mse_vectorized(individual)
+    results['approximation_evaluate_mse_vectorized_per_second'] = measure(evaluate_vectorized, len(population))
+    benchmark_operators(results, 'approximation_', initializer.pset, population)
+
+    simple_gp_layer = simpleGp.FirstLayer(initializer.pset, grid_points, CsvExportRecorder())
+    simple_gp_layer.initialize_toolbox()
+    results['approximation_single_layer_generations_per_second'] = measure(
+        lambda: gp_evolution(0, None, 1, END_TO_END_POPULATION_SIZE, END_TO_END_GENERATIONS, 0.9, 0.01, 0,
+                             simple_gp_layer.toolbox, CsvExportRecorder(), 1, "approximation", None, 1),
+        END_TO_END_GENERATIONS)
+
+    def run_two_layers():
+        seed_everything(BENCHMARK_SEED)
+        first_layer.initialize_toolbox()
+        first_layer.set_points_for_run(grid_points)
+        sub_models = []
+        for process_id in range(END_TO_END_SUB_MODELS):
+            gp_evolution(process_id, sub_models, 1, END_TO_END_POPULATION_SIZE, END_TO_END_GENERATIONS, 0.9, 0.01, 1,
+                         first_layer.toolbox, CsvExportRecorder(), 1, "approximation", None, 2)
+        x_values, y_values = get_grid_values()
+        terminal_map = {f'sub_model_{i}': compute_output_vector(sub_model, initializer.pset, x_values, y_values)
+                        for i, sub_model in enumerate(sub_models)}
+        second_layer_initializer = GpSecondLayerInitializer(terminal_map)
+        second_layer_initializer.initialize_gp_run()
+        SecondLayer(initializer.pset, second_layer_initializer.pset,
+                    second_layer_initializer.pset_without_first_layer_terminals, CsvExportRecorder()).execute_run()
+    results['approximation_two_layer_generations_per_second'] = measure(
+        run_two_layers, END_TO_END_SUB_MODELS * END_TO_END_GENERATIONS + SecondLayer.NUMBER_OF_GENERATIONS)
+
+
+def benchmark_multiplexer(results):
+    initializer = GpFirstLayerMUXInitializer()
+    initializer.initialize_gp_run()
+    first_layer = firstLayerMultiplexer.FirstLayer(initializer.pset, CsvExportRecorder())
+    first_layer.initialize_toolbox()
+    population = get_reference_population(first_layer.toolbox, REFERENCE_POPULATION_SIZE)
+    input_combinations = generate_all_input_combinations_for_model(0, {0: list(range(MUX_ADDRESSES_TO_APPROXIMATE))})
+
+    slow_population = population[:SLOW_EVALUATOR_POPULATION_SIZE]
+    results['mux_evaluate_per_second'] = measure(
+        lambda: [first_layer.evaluate_individual(individual, input_combinations) for individual in slow_population],
+        len(slow_population))
+
+    def evaluate_bit_parallel():
+        first_layer.truth_table = None
+        for individual in population:
+            first_layer.evaluate_individual_bit_parallel(individual, input_combinations)
+    results['mux_evaluate_bit_parallel_per_second'] = measure(evaluate_bit_parallel, len(population))
+    benchmark_operators(results, 'mux_', initializer.pset, population)
+
+    evaluate_individuals(first_layer.toolbox, population, input_combinations)
+    results['mux_koza_over_selection_per_second'] = measure(
+        lambda: koza_over_selection(population, len(population), 2, KOZA_OVER_SELECTION_POPULATION_SIZE), 1)
+
+    simple_multiplexer_layer = simpleMultiplexer.FirstLayer(initializer.pset, CsvExportRecorder())
+    simple_multiplexer_layer.initialize_toolbox()
+    results['mux_single_layer_generations_per_second'] = measure(
+        lambda: gp_evolution(0, None, 1, END_TO_END_POPULATION_SIZE, END_TO_END_GENERATIONS, 0.9, 0.05, 0,
+                             simple_multiplexer_layer.toolbox, CsvExportRecorder(), 1, "MUX", None, 1),
+        END_TO_END_GENERATIONS)
+
+    full_truth_table = BitParallelTruthTable(generate_all_possible_input_combinations())
+
+    def run_two_layers():
+        seed_everything(BENCHMARK_SEED)
+        first_layer.initialize_toolbox()
+        sub_models = []
+        for process_id in range(END_TO_END_SUB_MODELS):
+            addresses = random.sample(range(8), MUX_ADDRESSES_TO_APPROXIMATE)
+            gp_evolution(process_id, sub_models, 1, END_TO_END_POPULATION_SIZE, END_TO_END_GENERATIONS, 0.9, 0.05, 1,
+                         first_layer.toolbox, CsvExportRecorder(), 1, "MUX", {process_id: addresses}, 2)
+        terminal_map = {f'sub_model_{i}': full_truth_table.get_output_mask(sub_model, initializer.pset)
+                        for i, sub_model in enumerate(sub_models)}
+        second_layer_initializer = GpSecondLayerMUXInitializer(terminal_map)
+        second_layer_initializer.initialize_gp_run()
+        SecondLayerMultiplexer(initializer.pset, second_layer_initializer.pset,
+                               second_layer_initializer.pset_without_first_layer_terminals,
+                               CsvExportRecorder()).execute_run()
+    results['mux_two_layer_generations_per_second'] = measure(
+        run_two_layers, END_TO_END_SUB_MODELS * END_TO_END_GENERATIONS + SecondLayerMultiplexer.NUMBER_OF_GENERATIONS)
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = {}
+    for name, rate in results.items():
+        if name in baseline and rate < baseline[name] * (1 - tolerance):
+            regressions[name] = rate / baseline[name]
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the evaluators, genetic operators and short runs")
+    parser.add_argument('--save-baseline', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--baseline', type=Path, default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    arguments = parser.parse_args()
+    warnings.filterwarnings('ignore', message='A class named', category=RuntimeWarning)  # creator classes are redone
+
+    benchmark_results = {}
+    benchmark_approximation(benchmark_results)
+    benchmark_multiplexer(benchmark_results)
+
+    baseline_results = json.loads(arguments.baseline.read_text()) if arguments.baseline.exists() else {}
+    regression_ratios = find_regressions(benchmark_results, baseline_results, arguments.tolerance)
+    for benchmark_name, benchmark_rate in benchmark_results.items():
+        line = f"{benchmark_name:<55}{benchmark_rate:>14.1f}"
+        if benchmark_name in baseline_results:
+            line += f"{benchmark_rate / baseline_results[benchmark_name]:>8.2f}x baseline"
+        if benchmark_name in regression_ratios:
+            line += "  REGRESSION"
+        print(line)
+
+    if arguments.save_baseline:
+        arguments.baseline.write_text(json.dumps(benchmark_results, indent=4))
+        print("Baseline saved to " + str(arguments.baseline))
+    sys.exit(1 if regression_ratios else 0)
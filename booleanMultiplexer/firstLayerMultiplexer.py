@@ -1,5 +1,6 @@
 import concurrent.futures
 import random
+import sys
 from datetime import datetime
 
 import numpy as np
@@ -8,12 +9,22 @@ import traceback
 import multiprocessing
 
 from booleanMultiplexer.gpBooleanMultiplexerInitialization import GpFirstLayerMUXInitializer, NUMBER_OF_RUNS, \
-    MAX_TREE_HEIGHT, GpSecondLayerInitializer
+    MAX_TREE_HEIGHT, GpSecondLayerInitializer, BIT_PARALLEL_EVALUATION, SUBTREE_CACHE_SIZE_MB, BUFFERED_CSV_EXPORT, \
+    EXPERIMENT_STORE, PROFILE_EVOLUTION, SIMPLIFY_EVALUATED_TREES, SIMPLIFY_GENOTYPES, CHECKPOINT_INTERVAL, \
+    POPULATION_HISTORY
+from booleanMultiplexer.muxCustomLogic import BitParallelTruthTable, generate_all_possible_input_combinations, \
+    sample_input_combinations_per_address
 from booleanMultiplexer.secondLayerMultiplexer import SecondLayerMultiplexer
+from checkpoint import ExperimentCheckpoint, get_evolution_checkpoint
 from csvExport import CsvExporter
-from customLogic import koza_custom_two_point_crossover, trim_individual, gp_evolution
+from customLogic import koza_custom_two_point_crossover, trim_individual, gp_evolution, serialize_individuals, \
+    deserialize_individuals, register_simplification, register_selection, TOURNAMENT_SELECTION
+from islandModel import Migration, RING_TOPOLOGY
+from subtreeCache import SubtreeCache
+from treeCompiler import TreeCompiler
 
 TOURNAMENT_SIZE = 2
+SELECTION_METHOD = TOURNAMENT_SELECTION
 ELITES_SIZE = 1
 NUMBER_OF_GENERATIONS = 51
 POPULATION_SIZE = 50
@@ -24,9 +35,20 @@ TERMINALS_FROM_FIRST_LAYER = 1
 NUMBER_OF_ADDRESSES_TO_APPROXIMATE = 4
 CROSSOVER_PROBABILITY = 0.9
 MUTATION_PROBABILITY = 0.05
+ISLAND_MODEL = False  # exchange the best individuals between the sub-model processes during the evolution
+MIGRATION_INTERVAL = 5  # number of generations between migrations
+MIGRATION_SIZE = 2  # number of best individuals sent to another island
+MIGRATION_TOPOLOGY = RING_TOPOLOGY
+# Offspring are first scored on this percentage of the cases and only evaluated on all of them if they can still be
+# better than the worst individual of the population. Rejected offspring get the worst possible fitness instead of
+# their real one, so a run gives different results than without staging.
+STAGED_EVALUATION = False
+STAGED_EVALUATION_SAMPLE_PERCENTAGE = 10
+REPLACE_SEMANTIC_DUPLICATES = False  # replace offspring with the same truth table as another one by random trees
 
 first_layer_params = {
     'TOURNAMENT_SIZE': TOURNAMENT_SIZE,
+    'SELECTION_METHOD': SELECTION_METHOD,
     'ELITES_SIZE': ELITES_SIZE,
     'NUMBER_OF_GENERATIONS': NUMBER_OF_GENERATIONS,
     'POPULATION_SIZE': POPULATION_SIZE,
@@ -38,6 +60,15 @@ first_layer_params = {
     'NUMBER_OF_ADDRESSES_TO_APPROXIMATE': NUMBER_OF_ADDRESSES_TO_APPROXIMATE,
     'CROSSOVER_PROBABILITY': CROSSOVER_PROBABILITY,
     'MUTATION_PROBABILITY': MUTATION_PROBABILITY,
+    'ISLAND_MODEL': ISLAND_MODEL,
+    'MIGRATION_INTERVAL': MIGRATION_INTERVAL,
+    'MIGRATION_SIZE': MIGRATION_SIZE,
+    'MIGRATION_TOPOLOGY': MIGRATION_TOPOLOGY,
+    'BIT_PARALLEL_EVALUATION': BIT_PARALLEL_EVALUATION,
+    'SUBTREE_CACHE_SIZE_MB': SUBTREE_CACHE_SIZE_MB,
+    'STAGED_EVALUATION': STAGED_EVALUATION,
+    'STAGED_EVALUATION_SAMPLE_PERCENTAGE': STAGED_EVALUATION_SAMPLE_PERCENTAGE,
+    'REPLACE_SEMANTIC_DUPLICATES': REPLACE_SEMANTIC_DUPLICATES,
 }
 
 
@@ -48,10 +79,15 @@ class FirstLayer:
         self.pset = pset
         self.toolbox = None
         self.csv_exporter: CsvExporter = csv_exporter
+        self.truth_table = None
+        self.stage_truth_table = None
+        self.stage_input_combinations = None
+        self.subtree_cache = SubtreeCache(SUBTREE_CACHE_SIZE_MB * 1024 * 1024) if SUBTREE_CACHE_SIZE_MB > 0 else None
+        self.tree_compiler = TreeCompiler(pset.context, pset.arguments, called_per_point=True)
 
     # Define the fitness measure
     def evaluate_individual(self, individual, input_combinations):
-        function = gp.compile(expr=individual, pset=self.pset)
+        function = self.tree_compiler.compile(individual)
         correct_assessments = 0
         for input_combination in input_combinations:
             expected_output = bool(self.__get_expected_output(input_combination))
@@ -64,6 +100,36 @@ class FirstLayer:
                 correct_assessments += 1
         return correct_assessments,
 
+    def __get_truth_table(self, input_combinations):
+        # The same input combinations are passed for the whole run, so they only need to be packed once
+        if self.truth_table is None or self.truth_table.input_combinations is not input_combinations:
+            self.truth_table = BitParallelTruthTable(input_combinations)
+            if self.subtree_cache is not None:
+                self.subtree_cache.clear()
+        return self.truth_table
+
+    def evaluate_individual_bit_parallel(self, individual, input_combinations):
+        return self.__get_truth_table(input_combinations).evaluate(individual, self.pset, self.subtree_cache),
+
+    def get_semantics(self, individual, input_combinations):
+        truth_table = self.__get_truth_table(input_combinations)
+        if self.subtree_cache is not None:
+            return self.subtree_cache.evaluate(individual, truth_table.get_context(self.pset))
+        return truth_table.get_output_mask(individual, self.pset)
+
+    def evaluate_individual_staged(self, individual, input_combinations, rejection_threshold):
+        # evenly spread cases of every address for the first stage, packed once per run like the full truth table
+        if self.stage_input_combinations is not input_combinations:
+            self.stage_truth_table = BitParallelTruthTable(sample_input_combinations_per_address(
+                input_combinations, max(1, round(100 / STAGED_EVALUATION_SAMPLE_PERCENTAGE))))
+            self.stage_input_combinations = input_combinations
+        # Even if all the other cases were right, the individual could not get more correct assessments than this
+        correct_assessments_upper_bound = (self.stage_truth_table.evaluate(individual, self.pset) +
+                                           len(input_combinations) - self.stage_truth_table.number_of_cases)
+        if correct_assessments_upper_bound < rejection_threshold:
+            return 0,  # rejected, the worst possible fitness
+        return self.toolbox.evaluate(individual, input_combinations)
+
     def __get_expected_output(self, input_combination):
         address_string = input_combination[:3]
         address = int(address_string, 2)
@@ -79,10 +145,18 @@ class FirstLayer:
         self.toolbox.register("population", tools.initRepeat, list, self.toolbox.individual)
         self.toolbox.register("mate", koza_custom_two_point_crossover)
         self.toolbox.register("mutate", gp.mutNodeReplacement, pset=self.pset)
-        self.toolbox.register("evaluate", self.evaluate_individual)
-        self.toolbox.register("select", tools.selTournament, tournsize=TOURNAMENT_SIZE)
+        if BIT_PARALLEL_EVALUATION:
+            self.toolbox.register("evaluate", self.evaluate_individual_bit_parallel)
+        else:
+            self.toolbox.register("evaluate", self.evaluate_individual)
+        if STAGED_EVALUATION:
+            self.toolbox.register("evaluate_staged", self.evaluate_individual_staged)
+        if REPLACE_SEMANTIC_DUPLICATES:
+            self.toolbox.register("get_semantics", self.get_semantics)
+        register_selection(self.toolbox, SELECTION_METHOD, TOURNAMENT_SIZE)
         self.toolbox.register("trim", trim_individual, max_tree_height=MAX_TREE_HEIGHT, pset=self.pset,
-                              csv_export=self.csv_exporter, second_layer=False)
+                              csv_export=self.csv_exporter)
+        register_simplification(self.toolbox, self.pset, SIMPLIFY_EVALUATED_TREES, SIMPLIFY_GENOTYPES)
 
     def __calculate_avg_fitness(self, population):
         total_fitness = 0
@@ -92,62 +166,121 @@ class FirstLayer:
         return total_fitness / len(population)
 
 
+# State of a process in the persistent worker pool, loaded once per experiment by initialize_worker
+worker_state = {}
+
+
+def initialize_worker(pset, csv_exporter, migration_inboxes):
+    first_layer_instance = FirstLayer(pset, csv_exporter)
+    first_layer_instance.initialize_toolbox()
+    worker_state['first_layer_instance'] = first_layer_instance
+    worker_state['migration_inboxes'] = migration_inboxes
+
+
+def evolve_sub_model(run_number, process_id, seed, addresses_to_approximate):
+    first_layer_instance = worker_state['first_layer_instance']
+    random.seed(seed)
+    np.random.seed(seed)
+    first_layer_instance.csv_exporter.set_run_number(run_number)
+    migration = get_migration(process_id, run_number)
+    checkpoint = get_evolution_checkpoint(first_layer_instance.csv_exporter, 1, process_id, CHECKPOINT_INTERVAL)
+    sub_models = []
+    gp_evolution(process_id, sub_models, ELITES_SIZE, POPULATION_SIZE, NUMBER_OF_GENERATIONS,
+                 CROSSOVER_PROBABILITY, MUTATION_PROBABILITY, TERMINALS_FROM_FIRST_LAYER,
+                 first_layer_instance.toolbox, first_layer_instance.csv_exporter, 1, "MUX",
+                 {process_id: addresses_to_approximate}, 2, migration, PROFILE_EVOLUTION, checkpoint,
+                 POPULATION_HISTORY)
+    first_layer_instance.csv_exporter.flush()
+    return serialize_individuals(sub_models)
+
+
+def execute_run(run_number, pset, full_truth_table, csv_exporter, executor=None):
+    # Evolves the sub-models of one run in the pool of executor, or one after the other in this process if there is
+    # none, and the second layer on their outputs. Returns the best individual of the second layer.
+    address_pool = list(range(0, 8))
+    process_addresses_map = {}
+    for process_id in range(NUMBER_OF_SUB_MODELS):
+        if len(address_pool) < NUMBER_OF_ADDRESSES_TO_APPROXIMATE:
+            # TODO not a great solution: could make some addresses not present in final map
+            address_pool = list(range(0, 8))
+        process_addresses_map[process_id] = random.sample(address_pool, NUMBER_OF_ADDRESSES_TO_APPROXIMATE)
+        for address in process_addresses_map[process_id]:
+            address_pool.remove(address)
+    sub_model_arguments = [(run_number, process_id, random.randrange(2 ** 32), process_addresses_map[process_id])
+                           for process_id in range(NUMBER_OF_SUB_MODELS)]
+    if executor is None:
+        serialized_sub_models = [evolve_sub_model(*arguments) for arguments in sub_model_arguments]
+    else:
+        futures = [executor.submit(evolve_sub_model, *arguments) for arguments in sub_model_arguments]
+        serialized_sub_models = [future.result() for future in futures]
+    # Sub-models come back in process order as expressions with their fitness
+    new_terminals = []
+    for serialized_sub_model in serialized_sub_models:
+        new_terminals += deserialize_individuals(serialized_sub_model, pset)
+    csv_exporter.save_sub_models(new_terminals, run_number)
+    # Each distinct sub-model becomes a terminal holding its packed output over all 2048 input combinations, named
+    # after its row in the sub_models csv
+    terminal_map = {}
+    sub_model_expressions = set()
+    best_fitness = float("inf")
+    best_individual = None
+    for i, terminal in enumerate(new_terminals):
+        if str(terminal) not in sub_model_expressions:
+            sub_model_expressions.add(str(terminal))
+            terminal_map[f'sub_model_{i}'] = full_truth_table.get_output_mask(terminal, pset)
+        if best_fitness > terminal.fitness.values[0]:
+            best_fitness = terminal.fitness.values[0]
+            best_individual = terminal
+
+    print("Best fitness from first layer: " + str(best_fitness))
+    print("---------Second layer---------")
+
+    gp_second_layer_initializer = GpSecondLayerInitializer(terminal_map)
+    gp_second_layer_initializer.initialize_gp_run()
+    second_layer = SecondLayerMultiplexer(pset, gp_second_layer_initializer.pset,
+                                          gp_second_layer_initializer.pset_without_first_layer_terminals,
+                                          csv_exporter)
+    if run_number == 0:
+        csv_exporter.export_run_params_to_csv(first_layer_params, second_layer.second_layer_params)
+    best_overall_individual = second_layer.execute_run(get_evolution_checkpoint(csv_exporter, 2, 0,
+                                                                                CHECKPOINT_INTERVAL))
+    csv_exporter.save_best_individual(best_overall_individual, run_number)
+    return best_overall_individual
+
+
+def get_migration(process_id, run_number):
+    if not ISLAND_MODEL:
+        return None
+    return Migration(process_id, run_number, worker_state['migration_inboxes'],
+                     worker_state['first_layer_instance'].pset, MIGRATION_INTERVAL, MIGRATION_SIZE, MIGRATION_TOPOLOGY)
+
+
 if __name__ == "__main__":
+    # Usage: python firstLayerMultiplexer.py [<experiment folder>], passing the folder of an interrupted experiment
+    # resumes it
     try:
         now = datetime.now()
-        csv_exporter = CsvExporter(now)
-        manager = multiprocessing.Manager()
+        csv_exporter = CsvExporter(now, BUFFERED_CSV_EXPORT, EXPERIMENT_STORE,
+                                   sys.argv[1] if len(sys.argv) > 1 else None)
+        experiment_checkpoint = ExperimentCheckpoint(csv_exporter.folder_name)
         gp_first_layer_initializer = GpFirstLayerMUXInitializer()
         gp_first_layer_initializer.initialize_gp_run()
-        for run_number in range(NUMBER_OF_RUNS):
-            print("Starting run " + str(run_number))
-            new_terminals = manager.list()
-            first_layer_instance = FirstLayer(gp_first_layer_initializer.pset, csv_exporter)
-            first_layer_instance.initialize_toolbox()
-            address_pool = list(range(0, 8))
-            process_addresses_map = {}
-            for process_id in range(NUMBER_OF_SUB_MODELS):
-                if len(address_pool) < NUMBER_OF_ADDRESSES_TO_APPROXIMATE:
-                    address_pool = list(
-                        range(0, 8))  # TODO not a great solution: could make some addresses not present in final map
-                process_addresses_map[process_id] = random.sample(address_pool, NUMBER_OF_ADDRESSES_TO_APPROXIMATE)
-                for address in process_addresses_map[process_id]:
-                    address_pool.remove(address)
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                futures = [executor.submit(gp_evolution, process_id, new_terminals, ELITES_SIZE, POPULATION_SIZE,
-                                           NUMBER_OF_GENERATIONS, CROSSOVER_PROBABILITY,
-                                           MUTATION_PROBABILITY, TERMINALS_FROM_FIRST_LAYER,
-                                           first_layer_instance.toolbox, first_layer_instance.csv_exporter, 1, "MUX",
-                                           process_addresses_map, 2)
-                           for
-                           process_id
-                           in
-                           range(NUMBER_OF_SUB_MODELS)]
-
-                concurrent.futures.wait(futures)
-            csv_exporter.save_sub_models(new_terminals, run_number)
-            functions = []
-            terminal_map = {}
-            best_fitness = float("inf")
-            best_individual = None
-            for i, terminal in enumerate(new_terminals):
-                terminal_name = f'{terminal}'
-                terminal_map[terminal_name] = terminal
-                if best_fitness > terminal.fitness.values[0]:
-                    best_fitness = terminal.fitness.values[0]
-                    best_individual = terminal
-
-            print("Best fitness from first layer: " + str(best_fitness))
-            print("---------Second layer---------")
-
-            gp_second_layer_initializer = GpSecondLayerInitializer(terminal_map)
-            gp_second_layer_initializer.initialize_gp_run()
-            second_layer = SecondLayerMultiplexer(gp_first_layer_initializer.pset, gp_second_layer_initializer.pset,
-                                                  csv_exporter)
-            if run_number == 0:
-                csv_exporter.export_run_params_to_csv(first_layer_params, second_layer.second_layer_params)
-            best_overall_individual = second_layer.execute_run()
-            csv_exporter.save_best_individual(best_overall_individual, run_number)
+        full_truth_table = BitParallelTruthTable(generate_all_possible_input_combinations())
+        # The creator classes are needed in this process as well to receive the sub-models
+        FirstLayer(gp_first_layer_initializer.pset, csv_exporter).initialize_toolbox()
+        # The inboxes of the islands are handed to the workers when the pool starts and reused for all the runs
+        migration_inboxes = [multiprocessing.Queue() for _ in range(NUMBER_OF_SUB_MODELS)] if ISLAND_MODEL else None
+        # One pool for the whole experiment, every worker loads the pset and toolbox only once
+        with concurrent.futures.ProcessPoolExecutor(initializer=initialize_worker,
+                                                    initargs=(gp_first_layer_initializer.pset, csv_exporter,
+                                                              migration_inboxes)) as executor:
+            for run_number in range(experiment_checkpoint.resume(), NUMBER_OF_RUNS):
+                print("Starting run " + str(run_number))
+                csv_exporter.set_run_number(run_number)
+                execute_run(run_number, gp_first_layer_initializer.pset, full_truth_table, csv_exporter, executor)
+                csv_exporter.flush()
+                if CHECKPOINT_INTERVAL > 0:
+                    experiment_checkpoint.save(run_number)
     except:
         traceback.print_exc()
 
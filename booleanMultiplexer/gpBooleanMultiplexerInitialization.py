@@ -1,9 +1,20 @@
+import copy
+
 from deap import gp
 
 from methodDefinitions import custom_and, custom_or, custom_not, custom_if
 
 NUMBER_OF_RUNS = 500
 MAX_TREE_HEIGHT = 17
+BIT_PARALLEL_EVALUATION = True  # evaluate all input combinations at once as bitwise operations on packed integers
+SUBTREE_CACHE_SIZE_MB = 32  # memory for caching subtree truth tables of the bit-parallel evaluation, 0 disables the cache
+BUFFERED_CSV_EXPORT = True  # write the csv files from a background thread, flushed after every run
+EXPERIMENT_STORE = False  # keep the per-generation history in experiment.sqlite instead of csv files
+POPULATION_HISTORY = False  # save the whole population of every generation, not only its best individual
+PROFILE_EVOLUTION = False  # save the time of each phase and the counters of every generation
+CHECKPOINT_INTERVAL = 10  # generations between the checkpoints of a run, 0 disables checkpoints
+SIMPLIFY_EVALUATED_TREES = False  # fold constants and remove identities before evaluating, the genotype stays as it is
+SIMPLIFY_GENOTYPES = False  # replace the offspring by their simplified trees before trimming
 
 
 class GpFirstLayerMUXInitializer:
@@ -41,6 +52,7 @@ class GpSecondLayerInitializer:
 
     def __init__(self, subsets):
         self.pset = None
+        self.pset_without_first_layer_terminals = None
         self.subsets = subsets
 
     def initialize_gp_run(self):
@@ -50,9 +62,13 @@ class GpSecondLayerInitializer:
 
     def __add_primitive_set(self):
         self.pset.addPrimitive(custom_and, 2)
+        self.pset_without_first_layer_terminals.addPrimitive(custom_and, 2)
         self.pset.addPrimitive(custom_or, 2)
+        self.pset_without_first_layer_terminals.addPrimitive(custom_or, 2)
         self.pset.addPrimitive(custom_not, 1)
+        self.pset_without_first_layer_terminals.addPrimitive(custom_not, 1)
         self.pset.addPrimitive(custom_if, 3)
+        self.pset_without_first_layer_terminals.addPrimitive(custom_if, 3)
 
     def __create_terminal_set(self):
         self.pset.renameArguments(ARG0="A0")
@@ -66,6 +82,7 @@ class GpSecondLayerInitializer:
         self.pset.renameArguments(ARG8="D5")
         self.pset.renameArguments(ARG9="D6")
         self.pset.renameArguments(ARG10="D7")
+        self.pset_without_first_layer_terminals = copy.deepcopy(self.pset)
         for individual in self.subsets:
             present = False
             # check if individual is not already present in the terminal list to avoid an exception due to the same
@@ -1,3 +1,9 @@
+from functools import partial
+
+from methodDefinitions import bitwise_and, bitwise_or, bitwise_not, bitwise_if
+from treeCompiler import TreeCompiler
+
+
 def generate_all_input_combinations_for_model(process_id, process_address_map):
     all_combinations = []
     for x in range(256):
@@ -6,3 +12,72 @@ def generate_all_input_combinations_for_model(process_id, process_address_map):
             all_combinations.append(process_id_bin_string + '{0:08b}'.format(
                 x))  # https://stackoverflow.com/questions/10411085/converting-integer-to-binary-in-python
     return all_combinations
+
+
+def generate_all_possible_input_combinations():
+    all_combinations = []
+    for x in range(2048):
+        all_combinations.append('{0:011b}'.format(x))
+    return all_combinations
+
+
+def sample_input_combinations_per_address(input_combinations, step):
+    # Every step-th combination of each address, so all the addresses of a model are in the sample. The combinations
+    # of a model interleave its addresses, so a plain stride could skip some of them entirely.
+    combinations_by_address = {}
+    for input_combination in input_combinations:
+        combinations_by_address.setdefault(input_combination[:3], []).append(input_combination)
+    return [input_combination for address_combinations in combinations_by_address.values()
+            for input_combination in address_combinations[::step]]
+
+
+def get_expected_output(input_combination):
+    address_string = input_combination[:3]
+    address = int(address_string, 2)
+    return int(input_combination[10 - address])
+
+
+# Packs a list of input combinations into one bitmask per input variable, bit i belongs to combination i
+class BitParallelTruthTable:
+
+    def __init__(self, input_combinations):
+        self.input_combinations = input_combinations
+        self.number_of_cases = len(input_combinations)
+        self.full_mask = (1 << self.number_of_cases) - 1
+        self.argument_masks = [0] * len(input_combinations[0])
+        self.target_mask = 0
+        for case_index, input_combination in enumerate(input_combinations):
+            case_bit = 1 << case_index
+            for argument_index, value in enumerate(input_combination):
+                if value == '1':
+                    self.argument_masks[argument_index] |= case_bit
+            if get_expected_output(input_combination) == 1:
+                self.target_mask |= case_bit
+        self.primitives = {
+            'custom_and': bitwise_and,
+            'custom_or': bitwise_or,
+            'custom_not': partial(bitwise_not, full_mask=self.full_mask),
+            'custom_if': partial(bitwise_if, full_mask=self.full_mask),
+        }
+        self.tree_compilers = {}  # one per primitive set, its context decides what the node names are bound to
+
+    def get_context(self, pset):
+        # Arguments are bound positionally, the same way the compiled function receives them
+        context = dict(pset.context)
+        context.update(self.primitives)
+        context.update(zip(pset.arguments, self.argument_masks))
+        return context
+
+    def get_output_mask(self, expr, pset):
+        tree_compiler = self.tree_compilers.get(pset)
+        if tree_compiler is None:
+            tree_compiler = self.tree_compilers[pset] = TreeCompiler(self.get_context(pset), pset.arguments)
+        return tree_compiler.compile(expr)(*self.argument_masks)
+
+    def count_correct_assessments(self, output_mask):
+        return self.number_of_cases - ((output_mask ^ self.target_mask) & self.full_mask).bit_count()
+
+    def evaluate(self, expr, pset, subtree_cache=None):
+        if subtree_cache is not None:
+            return self.count_correct_assessments(subtree_cache.evaluate(expr, self.get_context(pset)))
+        return self.count_correct_assessments(self.get_output_mask(expr, pset))
@@ -1,11 +1,16 @@
 from deap import gp, creator, base, tools, algorithms
 
-from booleanMultiplexer.gpBooleanMultiplexerInitialization import MAX_TREE_HEIGHT
-from customLogic import koza_custom_two_point_crossover, trim_individual, koza_over_selection, gp_evolution
+from booleanMultiplexer.gpBooleanMultiplexerInitialization import MAX_TREE_HEIGHT, SUBTREE_CACHE_SIZE_MB, \
+    PROFILE_EVOLUTION, SIMPLIFY_EVALUATED_TREES, SIMPLIFY_GENOTYPES, POPULATION_HISTORY
+from booleanMultiplexer.muxCustomLogic import BitParallelTruthTable
+from customLogic import koza_custom_two_point_crossover, trim_individual, koza_over_selection, gp_evolution, \
+    register_simplification, register_selection, TOURNAMENT_SELECTION
+from subtreeCache import SubtreeCache
 
 
 class SecondLayerMultiplexer:
     TOURNAMENT_SIZE = 2
+    SELECTION_METHOD = TOURNAMENT_SELECTION
     ELITES_SIZE = 1
     NUMBER_OF_GENERATIONS = 10
     POPULATION_SIZE = 200
@@ -16,6 +21,7 @@ class SecondLayerMultiplexer:
 
     second_layer_params = {
         'TOURNAMENT_SIZE': TOURNAMENT_SIZE,
+        'SELECTION_METHOD': SELECTION_METHOD,
         'ELITES_SIZE': ELITES_SIZE,
         'NUMBER_OF_GENERATIONS': NUMBER_OF_GENERATIONS,
         'POPULATION_SIZE': POPULATION_SIZE,
@@ -29,26 +35,20 @@ class SecondLayerMultiplexer:
     pset = None
     first_layer_pset = None
 
-    def __init__(self, first_layer_pset, second_layer_pset, csv_exporter):
+    def __init__(self, first_layer_pset, second_layer_pset, second_layer_pset_without_terminals_from_first_layer,
+                 csv_exporter):
         self.first_layer_pset = first_layer_pset
         self.pset = second_layer_pset
+        self.second_layer_pset_without_terminals_from_first_layer = second_layer_pset_without_terminals_from_first_layer
         self.input_combinations = self.generate_all_possible_input_combination()
+        self.truth_table = BitParallelTruthTable(self.input_combinations)
+        self.subtree_cache = SubtreeCache(SUBTREE_CACHE_SIZE_MB * 1024 * 1024) if SUBTREE_CACHE_SIZE_MB > 0 else None
         self.csv_exporter = csv_exporter
 
-    # Define the fitness measure
-    def __evaluate_individual(self, individual):
-        function = gp.compile(expr=individual, pset=self.pset)
-        correct_assessments = 0
-        for input_combination in self.input_combinations:
-            expected_output = bool(self.__get_expected_output(input_combination))
-            actual_output = function(
-                bool(int(input_combination[0])), bool(int(input_combination[1])), bool(int(input_combination[2])),
-                bool(int(input_combination[3])), bool(int(input_combination[4])), bool(int(input_combination[5])),
-                bool(int(input_combination[6])), bool(int(input_combination[7])), bool(int(input_combination[8])),
-                bool(int(input_combination[9])), bool(int(input_combination[10])))
-            if expected_output == actual_output:
-                correct_assessments += 1
-        return correct_assessments,
+    # Define the fitness measure. Sub-models from the first layer are terminals holding their precomputed truth table
+    # over all input combinations, so the second layer is always evaluated bit-parallel
+    def __evaluate_individual_bit_parallel(self, individual):
+        return self.truth_table.evaluate(individual, self.pset, self.subtree_cache),
 
     def __get_expected_output(self, input_combination):
         address_string = input_combination[:3]
@@ -73,11 +73,13 @@ class SecondLayerMultiplexer:
         toolbox.register("population", tools.initRepeat, list, toolbox.individual)
         toolbox.register("mate", koza_custom_two_point_crossover)
         toolbox.register("mutate", gp.mutNodeReplacement, pset=self.pset)
-        toolbox.register("evaluate", self.__evaluate_individual)
-        toolbox.register("select", tools.selTournament, tournsize=self.TOURNAMENT_SIZE)
+        toolbox.register("evaluate", self.__evaluate_individual_bit_parallel)
+        register_selection(toolbox, self.SELECTION_METHOD, self.TOURNAMENT_SIZE)
 
-        toolbox.register("trim", trim_individual, max_tree_height=MAX_TREE_HEIGHT, pset=self.first_layer_pset, # TODO will need tweaking when terminals and primitives change across layers
-                              csv_export=self.csv_exporter, second_layer=True)
+        toolbox.register("trim", trim_individual, max_tree_height=MAX_TREE_HEIGHT,
+                         pset=self.second_layer_pset_without_terminals_from_first_layer,
+                         csv_export=self.csv_exporter)
+        register_simplification(toolbox, self.pset, SIMPLIFY_EVALUATED_TREES, SIMPLIFY_GENOTYPES)
         return toolbox
 
     def __second_layer_evolution(self, toolbox):
@@ -91,8 +93,9 @@ class SecondLayerMultiplexer:
             print(f"Best individual: {best_current_individual}, Fitness: {best_current_individual.fitness.values[0]}")
             return best_current_individual
 
-    def execute_run(self):
+    def execute_run(self, checkpoint=None):
         toolbox = self.__prepare_run()
         return gp_evolution(0, None, self.ELITES_SIZE, self.POPULATION_SIZE, self.NUMBER_OF_GENERATIONS,
                             self.CROSSOVER_PROBABILITY, self.MUTATION_PROBABILITY, 0, toolbox, self.csv_exporter, 2,
-                            "MUX", None, 2)
+                            "MUX", None, 2, profile_generations=PROFILE_EVOLUTION, checkpoint=checkpoint,
+                            population_history=POPULATION_HISTORY)
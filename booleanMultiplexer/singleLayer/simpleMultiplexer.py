@@ -1,15 +1,26 @@
+import concurrent.futures
+import os
+import random
 from datetime import datetime
 
+import numpy as np
 from deap import base, creator, tools, gp
 import traceback
-import multiprocessing
 
 from booleanMultiplexer.gpBooleanMultiplexerInitialization import GpFirstLayerMUXInitializer, NUMBER_OF_RUNS, \
-    MAX_TREE_HEIGHT
+    MAX_TREE_HEIGHT, BIT_PARALLEL_EVALUATION, SUBTREE_CACHE_SIZE_MB, BUFFERED_CSV_EXPORT, EXPERIMENT_STORE, \
+    PROFILE_EVOLUTION, SIMPLIFY_EVALUATED_TREES, SIMPLIFY_GENOTYPES, POPULATION_HISTORY
+from booleanMultiplexer.muxCustomLogic import BitParallelTruthTable
 from csvExport import CsvExporter
-from customLogic import koza_custom_two_point_crossover, trim_individual, gp_evolution
+from customLogic import koza_custom_two_point_crossover, trim_individual, gp_evolution, serialize_individuals, \
+    deserialize_individuals, gp_steady_state_evolution, register_simplification, register_selection, \
+    TOURNAMENT_SELECTION
+from runScheduler import CsvExportRecorder, schedule_runs, replay_csv_export_calls
+from subtreeCache import SubtreeCache
+from treeCompiler import TreeCompiler
 
 TOURNAMENT_SIZE = 2
+SELECTION_METHOD = TOURNAMENT_SELECTION
 ELITES_SIZE = 1
 NUMBER_OF_GENERATIONS = 100
 POPULATION_SIZE = 200
@@ -17,9 +28,15 @@ MIN_TREE_INIT_HEIGHT = 2
 MAX_TREE_INIT_HEIGHT = 6
 CROSSOVER_PROBABILITY = 0.9
 MUTATION_PROBABILITY = 0.05
+STEADY_STATE_EVOLUTION = False  # insert every evaluated child right away instead of replacing whole generations
+NUMBER_OF_EVALUATIONS = POPULATION_SIZE * NUMBER_OF_GENERATIONS  # budget of the steady-state evolution
+# Processes evaluating the children of a steady-state run at the same time, 0 evaluates them one by one in the
+# process of the run
+STEADY_STATE_EVALUATION_WORKERS = 0
 
 first_layer_params = {
     'TOURNAMENT_SIZE': TOURNAMENT_SIZE,
+    'SELECTION_METHOD': SELECTION_METHOD,
     'ELITES_SIZE': ELITES_SIZE,
     'NUMBER_OF_GENERATIONS': NUMBER_OF_GENERATIONS,
     'POPULATION_SIZE': POPULATION_SIZE,
@@ -28,6 +45,11 @@ first_layer_params = {
     'MAX_TREE_INIT_HEIGHT': MAX_TREE_INIT_HEIGHT,
     'CROSSOVER_PROBABILITY': CROSSOVER_PROBABILITY,
     'MUTATION_PROBABILITY': MUTATION_PROBABILITY,
+    'STEADY_STATE_EVOLUTION': STEADY_STATE_EVOLUTION,
+    'NUMBER_OF_EVALUATIONS': NUMBER_OF_EVALUATIONS,
+    'STEADY_STATE_EVALUATION_WORKERS': STEADY_STATE_EVALUATION_WORKERS,
+    'BIT_PARALLEL_EVALUATION': BIT_PARALLEL_EVALUATION,
+    'SUBTREE_CACHE_SIZE_MB': SUBTREE_CACHE_SIZE_MB,
 }
 
 
@@ -38,10 +60,14 @@ class FirstLayer:
         self.toolbox = None
         self.csv_exporter: CsvExporter = csv_exporter
         self.input_combinations = self.generate_all_possible_input_combination()
+        self.truth_table = BitParallelTruthTable(self.input_combinations)
+        self.subtree_cache = SubtreeCache(SUBTREE_CACHE_SIZE_MB * 1024 * 1024) if SUBTREE_CACHE_SIZE_MB > 0 else None
+        self.tree_compiler = TreeCompiler(pset.context, pset.arguments, called_per_point=True)
+        self.number_of_evaluations = 0
 
     # Define the fitness measure
     def __evaluate_individual_MUX(self, individual):
-        function = gp.compile(expr=individual, pset=self.pset)
+        function = self.tree_compiler.compile(individual)
         correct_assessments = 0
         for input_combination in self.input_combinations:
             expected_output = bool(self.__get_expected_output(input_combination))
@@ -52,8 +78,13 @@ class FirstLayer:
                 bool(int(input_combination[9])), bool(int(input_combination[10])))
             if expected_output == actual_output:
                 correct_assessments += 1
+        self.number_of_evaluations += 1
         return correct_assessments,
 
+    def __evaluate_individual_MUX_bit_parallel(self, individual):
+        self.number_of_evaluations += 1
+        return self.truth_table.evaluate(individual, self.pset, self.subtree_cache),
+
     def __get_expected_output(self, input_combination):
         address_string = input_combination[:3]
         address = int(address_string, 2)
@@ -66,6 +97,9 @@ class FirstLayer:
                 x))  # https://stackoverflow.com/questions/10411085/converting-integer-to-binary-in-python
         return all_combinations
 
+    def count_evaluation(self):
+        self.number_of_evaluations += 1
+
     def initialize_toolbox(self):
         creator.create("FitnessMax", base.Fitness, weights=(1.0,))
         creator.create("Individual", gp.PrimitiveTree, fitness=creator.FitnessMax, pset=self.pset)
@@ -76,10 +110,18 @@ class FirstLayer:
         self.toolbox.register("population", tools.initRepeat, list, self.toolbox.individual)
         self.toolbox.register("mate", koza_custom_two_point_crossover)
         self.toolbox.register("mutate", gp.mutNodeReplacement, pset=self.pset)
-        self.toolbox.register("evaluate", self.__evaluate_individual_MUX)
-        self.toolbox.register("select", tools.selTournament, tournsize=TOURNAMENT_SIZE) # no longer need kozas overselection, because the population is quite small
+        if BIT_PARALLEL_EVALUATION:
+            self.toolbox.register("evaluate", self.__evaluate_individual_MUX_bit_parallel)
+        else:
+            self.toolbox.register("evaluate", self.__evaluate_individual_MUX)
+        register_selection(self.toolbox, SELECTION_METHOD, TOURNAMENT_SIZE) # no longer need kozas overselection, because the population is quite small
         self.toolbox.register("trim", trim_individual, max_tree_height=MAX_TREE_HEIGHT, pset=self.pset,
-                              csv_export=self.csv_exporter, second_layer=False)
+                              csv_export=self.csv_exporter)
+        register_simplification(self.toolbox, self.pset, SIMPLIFY_EVALUATED_TREES, SIMPLIFY_GENOTYPES)
+        if STEADY_STATE_EVALUATION_WORKERS > 0:
+            # The evaluation pool receives a module function instead of this instance
+            self.toolbox.register("evaluate_in_worker", evaluate_in_worker)
+            self.toolbox.register("count_evaluation", self.count_evaluation)
 
     def __calculate_avg_fitness(self, population):
         total_fitness = 0
@@ -89,23 +131,80 @@ class FirstLayer:
         return total_fitness / len(population)
 
 
+# State of a process in the run scheduler pool, loaded once by initialize_worker
+worker_state = {}
+
+
+def initialize_worker(pset):
+    csv_export_recorder = CsvExportRecorder()
+    first_layer_instance = FirstLayer(pset, csv_export_recorder)
+    first_layer_instance.initialize_toolbox()
+    worker_state['first_layer_instance'] = first_layer_instance
+    worker_state['csv_export_recorder'] = csv_export_recorder
+
+
+def evaluate_in_worker(individual, *args):
+    # Evaluates a child of a steady-state run in a process of the evaluation pool
+    return worker_state['first_layer_instance'].toolbox.evaluate(individual, *args)
+
+
+def execute_run(run_number, seed):
+    print("Starting run " + str(run_number))
+    first_layer_instance = worker_state['first_layer_instance']
+    csv_export_recorder = worker_state['csv_export_recorder']
+    random.seed(seed)
+    np.random.seed(seed)
+    first_layer_instance.number_of_evaluations = 0
+    if STEADY_STATE_EVOLUTION:
+        evaluation_executor = None
+        if STEADY_STATE_EVALUATION_WORKERS > 0:
+            evaluation_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=STEADY_STATE_EVALUATION_WORKERS, initializer=initialize_worker,
+                initargs=(first_layer_instance.pset,))
+        try:
+            best_individual = gp_steady_state_evolution(0, None, ELITES_SIZE, POPULATION_SIZE, NUMBER_OF_EVALUATIONS,
+                                                        CROSSOVER_PROBABILITY, MUTATION_PROBABILITY, 0,
+                                                        first_layer_instance.toolbox, csv_export_recorder, 1, "MUX",
+                                                        None, 1, evaluation_executor, STEADY_STATE_EVALUATION_WORKERS,
+                                                        population_history=POPULATION_HISTORY)
+        finally:
+            if evaluation_executor is not None:
+                evaluation_executor.shutdown(cancel_futures=True)
+    else:
+        best_individual = gp_evolution(0, None, ELITES_SIZE, POPULATION_SIZE, NUMBER_OF_GENERATIONS,
+                                       CROSSOVER_PROBABILITY, MUTATION_PROBABILITY, 0,
+                                       first_layer_instance.toolbox, csv_export_recorder, 1, "MUX", None, 1,
+                                       profile_generations=PROFILE_EVOLUTION, population_history=POPULATION_HISTORY)
+    return (serialize_individuals([best_individual]), first_layer_instance.number_of_evaluations,
+            csv_export_recorder.take_calls())
+
+
+def get_number_of_run_workers():
+    # Every steady-state run keeps its own evaluation pool busy, so fewer runs are started at the same time
+    if STEADY_STATE_EVOLUTION and STEADY_STATE_EVALUATION_WORKERS > 0:
+        return max(1, (os.cpu_count() or 1) // STEADY_STATE_EVALUATION_WORKERS)
+    return None
+
+
 if __name__ == "__main__":
     try:
         now = datetime.now()
-        csvExporter = CsvExporter(now)
-        manager = multiprocessing.Manager()
+        csvExporter = CsvExporter(now, BUFFERED_CSV_EXPORT, EXPERIMENT_STORE)
         gp_boolean_multiplexer_init = GpFirstLayerMUXInitializer()
         gp_boolean_multiplexer_init.initialize_gp_run()
-        for run_number in range(NUMBER_OF_RUNS):
-            print("Starting run " + str(run_number))
-            first_layer_instance = FirstLayer(gp_boolean_multiplexer_init.pset, csvExporter)
-            first_layer_instance.initialize_toolbox()
-            best_individual = gp_evolution(0, None, ELITES_SIZE, POPULATION_SIZE, NUMBER_OF_GENERATIONS,
-                                           CROSSOVER_PROBABILITY, MUTATION_PROBABILITY, 0,
-                                           first_layer_instance.toolbox, csvExporter, 1, "MUX", None, 1)
+        # The creator classes are needed in this process as well to receive the results
+        FirstLayer(gp_boolean_multiplexer_init.pset, csvExporter).initialize_toolbox()
+        for run_number, run_result in schedule_runs(execute_run, NUMBER_OF_RUNS, initialize_worker,
+                                                    (gp_boolean_multiplexer_init.pset,), get_number_of_run_workers()):
+            serialized_best_individual, number_of_evaluations, csv_export_calls = run_result
+            csvExporter.set_run_number(run_number)
+            replay_csv_export_calls(csv_export_calls, csvExporter)
+            best_individual = deserialize_individuals(serialized_best_individual, gp_boolean_multiplexer_init.pset)[0]
             if run_number == 0:
                 csvExporter.export_run_params_to_csv(first_layer_params, {})
             csvExporter.save_best_individual(best_individual, run_number)
+            csvExporter.save_number_of_approximations(number_of_evaluations, run_number)
+            csvExporter.flush()
     except:
         traceback.print_exc()
 
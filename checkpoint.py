@@ -0,0 +1,97 @@
+import os
+import pickle
+import random
+from pathlib import Path
+
+import numpy as np
+
+CHECKPOINT_FOLDER_NAME = 'checkpoints'
+EXPERIMENT_CHECKPOINT_FILE_NAME = 'experiment_checkpoint.pkl'
+
+
+def save_atomically(file_path, state):
+    # The checkpoint is written to a temporary file first and then renamed, so a crash while writing leaves the
+    # previous checkpoint intact
+    Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+    temporary_file_path = Path(str(file_path) + '.tmp')
+    with open(temporary_file_path, 'wb') as file:
+        pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_file_path, file_path)
+
+
+def load(file_path):
+    if not Path(file_path).exists():
+        return None
+    with open(file_path, 'rb') as file:
+        return pickle.load(file)
+
+
+def get_random_state():
+    return {'random': random.getstate(), 'numpy': np.random.get_state()}
+
+
+def set_random_state(random_state):
+    random.setstate(random_state['random'])
+    np.random.set_state(random_state['numpy'])
+
+
+class ExperimentCheckpoint:
+    # Saved after every finished run in the folder of the CsvExporter, holding the number of the next run and the
+    # random state the next run starts with. Runs that were interrupted continue from their EvolutionCheckpoints.
+
+    def __init__(self, folder_name):
+        self.file_path = Path(folder_name) / EXPERIMENT_CHECKPOINT_FILE_NAME
+        self.folder_name = folder_name
+
+    def save(self, finished_run_number):
+        save_atomically(self.file_path, {'next_run_number': finished_run_number + 1,
+                                         'random_state': get_random_state()})
+        # The generations of the finished run are not needed anymore
+        for file_path in (Path(self.folder_name) / CHECKPOINT_FOLDER_NAME).glob(f'run_{finished_run_number}_*'):
+            file_path.unlink()
+
+    def resume(self):
+        # Returns the number of the run to continue with
+        state = load(self.file_path)
+        if state is None:
+            return 0
+        set_random_state(state['random_state'])
+        return state['next_run_number']
+
+
+class EvolutionCheckpoint:
+    # Population, hall of fame and random state of one gp_evolution call, saved every checkpoint_interval generations
+    # and after the last one. The csv rows are flushed first, so the files hold every generation the checkpoint
+    # contains.
+
+    def __init__(self, folder_name, run_number, layer_number, process_id, checkpoint_interval):
+        self.file_path = (Path(folder_name) / CHECKPOINT_FOLDER_NAME /
+                          f'run_{run_number}_layer_{layer_number}_process_{process_id}.pkl')
+        self.checkpoint_interval = checkpoint_interval
+
+    def is_checkpoint_generation(self, generation_number, number_of_generations):
+        return ((generation_number + 1) % self.checkpoint_interval == 0 or
+                generation_number + 1 == number_of_generations)
+
+    def exists(self):
+        return self.file_path.exists()
+
+    def save(self, next_generation_number, population, hall_of_fame):
+        save_atomically(self.file_path, {'next_generation_number': next_generation_number, 'population': population,
+                                         'elites': list(hall_of_fame.items), 'random_state': get_random_state()})
+
+    def resume(self, hall_of_fame):
+        # Restores the hall of fame and the random state, returns the population and the generation to continue with
+        state = load(self.file_path)
+        hall_of_fame.update(state['elites'])
+        set_random_state(state['random_state'])
+        return state['population'], state['next_generation_number']
+
+
+def get_evolution_checkpoint(csv_exporter, layer_number, process_id, checkpoint_interval):
+    if checkpoint_interval <= 0:
+        return None
+    return EvolutionCheckpoint(csv_exporter.folder_name, csv_exporter.run_number, layer_number, process_id,
+                               checkpoint_interval)
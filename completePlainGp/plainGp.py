@@ -1,28 +1,67 @@
+import random
 import traceback
 
 import numpy as np
 from datetime import datetime
 
 from csvExport import CsvExporter
-from functionApproximation.firstLayer import FirstLayer, first_layer_params
-from functionApproximation.gpInitialization import GpFirstLayerInitializer, X_RANGE, Y_RANGE, NUMBER_OF_RUNS
+from customLogic import gp_evolution, serialize_individuals, deserialize_individuals
+from dataSource import load_points
+from functionApproximation.firstLayer import FirstLayer, first_layer_params, ELITES_SIZE, POPULATION_SIZE, \
+    NUMBER_OF_GENERATIONS, CROSSOVER_PROBABILITY, MUTATION_PROBABILITY
+from functionApproximation.gpInitialization import GpFirstLayerInitializer, NUMBER_OF_RUNS, \
+    BUFFERED_CSV_EXPORT, EXPERIMENT_STORE, PROFILE_EVOLUTION, POPULATION_HISTORY
+from runScheduler import CsvExportRecorder, schedule_runs, replay_csv_export_calls
+
+# State of a process in the run scheduler pool, loaded once by initialize_worker
+worker_state = {}
+
+
+def initialize_worker(pset, grid_points):
+    csv_export_recorder = CsvExportRecorder()
+    first_layer_instance = FirstLayer(pset, grid_points, csv_export_recorder)
+    first_layer_instance.initialize_toolbox()
+    worker_state['first_layer_instance'] = first_layer_instance
+    worker_state['csv_export_recorder'] = csv_export_recorder
+    worker_state['grid_points'] = grid_points
+
+
+def execute_run(run_number, seed):
+    print("Starting run " + str(run_number))
+    first_layer_instance = worker_state['first_layer_instance']
+    csv_export_recorder = worker_state['csv_export_recorder']
+    random.seed(seed)
+    np.random.seed(seed)
+    first_layer_instance.set_points_for_run(worker_state['grid_points'])
+    first_layer_instance.number_of_approximations = 0
+    best_individual = gp_evolution(0, None, ELITES_SIZE, POPULATION_SIZE, NUMBER_OF_GENERATIONS,
+                                   CROSSOVER_PROBABILITY, MUTATION_PROBABILITY, 0, first_layer_instance.toolbox,
+                                   csv_export_recorder, 1, "approximation", None, 1,
+                                   profile_generations=PROFILE_EVOLUTION, population_history=POPULATION_HISTORY)
+    return (serialize_individuals([best_individual]), first_layer_instance.number_of_approximations,
+            csv_export_recorder.take_calls())
+
 
 if __name__ == "__main__":
     try:
         now = datetime.now()
-        csvExporter = CsvExporter(now)
+        csvExporter = CsvExporter(now, BUFFERED_CSV_EXPORT, EXPERIMENT_STORE)
         gp_first_layer_initializer = GpFirstLayerInitializer()
         gp_first_layer_initializer.initialize_gp_run()
-        X, Y = np.meshgrid(X_RANGE, Y_RANGE)
-        grid_points = np.column_stack((X.flatten(), Y.flatten()))
-        new_terminals = []
-        for run_number in range(NUMBER_OF_RUNS):
-            print("Starting run " + str(run_number))
-            first_layer_instance = FirstLayer(gp_first_layer_initializer.pset, grid_points, csvExporter)
-            best_individual = first_layer_instance.first_layer_evolution(0, [])
-            best_fitness = float("inf")
+        # A single layer, so the points may also come from POINTS_FILE
+        grid_points = load_points()
+        # The creator classes are needed in this process as well to receive the results
+        FirstLayer(gp_first_layer_initializer.pset, grid_points, csvExporter).initialize_toolbox()
+        for run_number, run_result in schedule_runs(execute_run, NUMBER_OF_RUNS, initialize_worker,
+                                                    (gp_first_layer_initializer.pset, grid_points)):
+            serialized_best_individual, number_of_approximations, csv_export_calls = run_result
+            csvExporter.set_run_number(run_number)
+            replay_csv_export_calls(csv_export_calls, csvExporter)
+            best_individual = deserialize_individuals(serialized_best_individual, gp_first_layer_initializer.pset)[0]
             if run_number == 0:
                 csvExporter.export_run_params_to_csv(first_layer_params, {})
             csvExporter.save_best_individual(best_individual, run_number)
+            csvExporter.save_number_of_approximations(number_of_approximations, run_number)
+            csvExporter.flush()
     except:
         traceback.print_exc()
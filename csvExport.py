@@ -1,15 +1,87 @@
+import atexit
+import io
+import os
+import queue
+import threading
 import traceback
 import csv
 from pathlib import Path
 
 from customLogic import get_individual_height
+from experimentStore import ExperimentStore, EXPERIMENT_STORE_FILE_NAME, BEST_INDIVIDUAL_RECORD, POPULATION_RECORD
+
+WRITE_BUFFER_SIZE_BYTES = 64 * 1024  # pending rows of a file are written out once they reach this size
 
 
 class CsvExporter:
+    # In buffered mode the rows are formatted by the caller and handed to a background thread, which keeps one open
+    # handle per file and writes the rows in large appends. Writes always end on a row boundary, so rows from several
+    # processes appending to the same file are not interleaved. Call flush at the end of a run, the rest is flushed
+    # when the process exits.
+    # With an experiment store, the per-generation history goes to experiment.sqlite instead of csv files and can be
+    # exported to them later. Set the run number before the generation loop, the history is indexed by it.
+    # Passing the folder of an earlier experiment appends to its files, used to resume it.
 
-    def __init__(self, now):
-        self.folder_name = self.__get_folder_name(now)
+    def __init__(self, now, buffered=False, experiment_store=False, folder_name=None):
+        self.folder_name = Path(folder_name) if folder_name is not None else self.__get_folder_name(now)
+        self.buffered = buffered
+        self.run_number = 0
         self.__create_a_folder()
+        self.experiment_store = None
+        if experiment_store:
+            self.experiment_store = ExperimentStore(self.folder_name / EXPERIMENT_STORE_FILE_NAME)
+        self.__start_writer()
+        self.__register_close_at_exit()
+
+    def __getstate__(self):
+        # The queue, thread and file handles stay in the process that created them, the workers start their own
+        state = self.__dict__.copy()
+        for attribute in ('_CsvExporter__writer_process_id', '_CsvExporter__rows_queue', '_CsvExporter__files',
+                          '_CsvExporter__pending_text'):
+            state.pop(attribute, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__start_writer()
+        self.__register_close_at_exit()
+
+    def __register_close_at_exit(self):
+        if self.buffered or self.experiment_store is not None:
+            atexit.register(self.close)
+
+    def __start_writer(self):
+        if not self.buffered:
+            return
+        self.__writer_process_id = os.getpid()
+        self.__rows_queue = queue.Queue()
+        self.__files = {}
+        self.__pending_text = {}
+        threading.Thread(target=self.__write_queued_rows, daemon=True).start()
+
+    def __ensure_writer(self):
+        # A forked worker inherits the queue but not the writer thread
+        if self.__writer_process_id != os.getpid():
+            self.__start_writer()
+
+    def set_run_number(self, run_number):
+        self.run_number = run_number
+
+    def flush(self):
+        if self.experiment_store is not None:
+            self.experiment_store.flush()
+        if self.buffered:
+            self.__ensure_writer()
+            self.__rows_queue.put((None, 'flush', None))
+            self.__rows_queue.join()
+
+    def close(self):
+        if self.experiment_store is not None:
+            self.experiment_store.close()
+        if self.buffered:
+            self.__ensure_writer()
+            self.__rows_queue.put((None, 'close', None))
+            self.__rows_queue.join()
 
     @staticmethod
     def __get_folder_name(now):
@@ -24,73 +96,142 @@ class CsvExporter:
 
     def save_best_individual(self, best_individual, run_number):
         file_path = self.folder_name / 'best_individual.csv'
-        with open(file_path, 'a', newline='') as file:
-            writer = csv.writer(file, delimiter=';')
-            if run_number == 0:
-                writer.writerow(['Run number', 'Individual', 'Fitness'])
-            writer.writerow([run_number, best_individual, best_individual.fitness.values[0]])
+        rows = []
+        if run_number == 0:
+            rows.append(['Run number', 'Individual', 'Fitness'])
+        rows.append([run_number, best_individual, best_individual.fitness.values[0]])
+        self.__write_rows(file_path, rows)
 
     def save_best_individual_for_each_generation(self, best_individual, generation_number, layer_number):
-        folder_path = self.folder_name / str(layer_number)
-        Path(folder_path).mkdir(parents=True, exist_ok=True)
-        file_path = folder_path / 'best_individual_generation.csv'
-        with open(file_path, 'a', newline='') as file:
-            writer = csv.writer(file, delimiter=';')
-            if generation_number == 0:
-                writer.writerow(['Generation Number', 'Individual', 'Fitness', 'Height'])
-            writer.writerow([generation_number, best_individual, best_individual.fitness.values[0],
-                             get_individual_height(best_individual)])
-
-    def save_whole_population_for_each_generation(self, population, generation_number, run_number):
-        file_name = 'population' + str(generation_number) + '.csv'
-        folder_path = self.folder_name / str(run_number)
-        Path(folder_path).mkdir(parents=True, exist_ok=True)
-        file_path = folder_path / file_name
-        with open(file_path, 'a', newline='') as file:
-            writer = csv.writer(file, delimiter=';')
-            writer.writerow(['Individual', 'Fitness'])
+        if self.experiment_store is not None:
+            self.experiment_store.add_record(BEST_INDIVIDUAL_RECORD, self.run_number, layer_number, generation_number,
+                                             best_individual)
+            return
+        file_path = self.folder_name / str(layer_number) / 'best_individual_generation.csv'
+        rows = []
+        if generation_number == 0:
+            rows.append(['Generation Number', 'Individual', 'Fitness', 'Height'])
+        rows.append([generation_number, best_individual, best_individual.fitness.values[0],
+                     get_individual_height(best_individual)])
+        self.__write_rows(file_path, rows)
+
+    def save_generation_profile(self, generation_profile):
+        # One file per process, the sub-models of a run are evolved in several processes at the same time and each of
+        # them writes its own header
+        file_name = f'generation_profile_{generation_profile.process_id}.csv'
+        file_path = self.folder_name / str(generation_profile.layer_number) / file_name
+        record = generation_profile.as_record()
+        rows = []
+        if self.run_number == 0 and generation_profile.generation_number == 0:
+            rows.append(['Run number'] + [key.replace('_', ' ').capitalize() for key in record])
+        rows.append([self.run_number] + list(record.values()))
+        self.__write_rows(file_path, rows)
+
+    def save_whole_population_for_each_generation(self, population, generation_number, layer_number):
+        if self.experiment_store is not None:
             for individual in population:
-                writer.writerow([individual, individual.fitness.values[0]])
+                self.experiment_store.add_record(POPULATION_RECORD, self.run_number, layer_number, generation_number,
+                                                 individual)
+            return
+        file_name = 'population' + str(generation_number) + '.csv'
+        file_path = self.folder_name / str(layer_number) / str(self.run_number) / file_name
+        rows = [['Individual', 'Fitness']]
+        for individual in population:
+            rows.append([individual, individual.fitness.values[0]])
+        self.__write_rows(file_path, rows, 'w')
 
     def save_sub_models(self, sub_models, run_number):
-        folder_path = self.folder_name / 'sub_models'
-        Path(folder_path).mkdir(parents=True, exist_ok=True)
-        file_path = folder_path / f'sub_models_{run_number}.csv'
-        with open(file_path, 'w', newline='') as file:
-            writer = csv.writer(file, delimiter=';')
-            writer.writerow(['Individual', 'Fitness'])
-            for sub_model in sub_models:
-                writer.writerow([sub_model, sub_model.fitness.values[0]])
+        file_path = self.folder_name / 'sub_models' / f'sub_models_{run_number}.csv'
+        rows = [['Individual', 'Fitness']]
+        for sub_model in sub_models:
+            rows.append([sub_model, sub_model.fitness.values[0]])
+        self.__write_rows(file_path, rows, 'w')
 
     def __save_first_layer_params_to_csv(self, first_layer_params):
         file_path = self.folder_name / 'first_layer_params.csv'
-        with open(file_path, 'w', newline='') as file:
-            writer = csv.writer(file, delimiter=';')
-            writer.writerow(['Parameter', 'Value'])
-            for key, value in first_layer_params.items():
-                writer.writerow([key, value])
+        rows = [['Parameter', 'Value']]
+        for key, value in first_layer_params.items():
+            rows.append([key, value])
+        self.__write_rows(file_path, rows, 'w')
 
     def __save_second_layer_params_to_csv(self, second_layer_params):
         file_path = self.folder_name / 'second_layer_params.csv'
-        with open(file_path, 'w', newline='') as file:
-            writer = csv.writer(file, delimiter=';')
-            writer.writerow(['Parameter', 'Value'])
-            for key, value in second_layer_params.items():
-                writer.writerow([key, value])
+        rows = [['Parameter', 'Value']]
+        for key, value in second_layer_params.items():
+            rows.append([key, value])
+        self.__write_rows(file_path, rows, 'w')
 
     def save_number_of_approximations(self, number_of_approximations, run_number):
         file_path = self.folder_name / 'number_of_approximations.csv'
-        with open(file_path, 'a', newline='') as file:
-            writer = csv.writer(file, delimiter=';')
-            if run_number == 0:
-                writer.writerow(['Run number', 'Number of approximations'])
-            writer.writerow([run_number, number_of_approximations])
+        rows = []
+        if run_number == 0:
+            rows.append(['Run number', 'Number of approximations'])
+        rows.append([run_number, number_of_approximations])
+        self.__write_rows(file_path, rows)
+
+    def save_sweep_round(self, round_number, configuration_results, number_of_kept_configurations):
+        # configuration_results are ordered from the best to the worst configuration of the round
+        file_path = self.folder_name / 'sweep.csv'
+        rows = []
+        if round_number == 0:
+            rows.append(['Round', 'Configuration', 'Parameters', 'Runs', 'Success rate', 'Mean best fitness', 'Kept'])
+        for rank, results in enumerate(configuration_results):
+            rows.append([round_number, results.configuration_number, results.configuration,
+                         results.get_number_of_runs(), results.get_success_rate(), results.get_mean_best_fitness(),
+                         rank < number_of_kept_configurations])
+        self.__write_rows(file_path, rows)
 
     def save_pruned_tree(self, pruned_tree):
         file_path = self.folder_name / 'pruned_trees.csv'
-        with open(file_path, 'a', newline='') as file:
-            writer = csv.writer(file, delimiter=';')
-            writer.writerow([str(pruned_tree)])
+        self.__write_rows(file_path, [[str(pruned_tree)]])
+
+    def __write_rows(self, file_path, rows, mode='a'):
+        if not self.buffered:
+            Path(file_path.parent).mkdir(parents=True, exist_ok=True)
+            with open(file_path, mode, newline='') as file:
+                writer = csv.writer(file, delimiter=';')
+                writer.writerows(rows)
+            return
+        # The rows are turned into text right away, the individuals may change after this call
+        text = io.StringIO()
+        csv.writer(text, delimiter=';').writerows(rows)
+        self.__ensure_writer()
+        self.__rows_queue.put((file_path, mode, text.getvalue()))
+
+    def __write_queued_rows(self):
+        while True:
+            file_path, mode, text = self.__rows_queue.get()
+            try:
+                if file_path is None:
+                    self.__write_pending_text(list(self.__pending_text))
+                    if mode == 'close':
+                        for file in self.__files.values():
+                            file.close()
+                        self.__files.clear()
+                else:
+                    if mode == 'w' or file_path not in self.__files:
+                        self.__open_file(file_path, mode)
+                    pending_text = self.__pending_text.setdefault(file_path, bytearray())
+                    pending_text += text.encode()
+                    if len(pending_text) >= WRITE_BUFFER_SIZE_BYTES:
+                        self.__write_pending_text([file_path])
+            except:
+                traceback.print_exc()
+            finally:
+                self.__rows_queue.task_done()
+
+    def __open_file(self, file_path, mode):
+        if file_path in self.__files:
+            self.__files.pop(file_path).close()
+        self.__pending_text.pop(file_path, None)
+        Path(file_path.parent).mkdir(parents=True, exist_ok=True)
+        self.__files[file_path] = open(file_path, mode + 'b', buffering=0)
+
+    def __write_pending_text(self, file_paths):
+        for file_path in file_paths:
+            pending_text = self.__pending_text.pop(file_path, None)
+            if pending_text:
+                self.__files[file_path].write(pending_text)
 
     def __create_a_folder(self):
         try:
@@ -1,3 +1,4 @@
+import concurrent.futures
 import random
 
 import deap
@@ -6,6 +7,18 @@ from deap.tools import selection
 import traceback
 
 from booleanMultiplexer.muxCustomLogic import generate_all_input_combinations_for_model
+from evolutionProfile import GenerationProfile, time_phase
+from treeCompiler import get_structural_key
+from treeSimplifier import simplify_individual
+
+TOURNAMENT_SELECTION = "tournament"
+DOUBLE_TOURNAMENT_SELECTION = "double_tournament"  # fitness tournaments, the winners compete again on their size
+TARPEIAN_SELECTION = "tarpeian"  # some of the larger than average trees lose every tournament
+LEXICOGRAPHIC_PARSIMONY_SELECTION = "lexicographic_parsimony"  # equal fitness is decided by the smaller tree
+PARSIMONY_TOURNAMENT_SIZE = 1.4  # between 1 and 2, the smaller tree wins the size round with probability size / 2
+TARPEIAN_PROBABILITY = 0.3  # probability that a larger than average tree loses every tournament of one selection
+
+trimmed_tree_count = 0  # over-height trees cut by trim_individual in this process, read by the generation profile
 
 
 def koza_custom_two_point_crossover(parent1, parent2):
@@ -57,65 +70,57 @@ def get_individual_height(individual):
     return max_depth
 
 
-def get_nodes_with_height(individual, height):
+def evaluate_simplified(individual, *arguments, evaluate, pset):
+    # Evaluates the simplified tree, the individual itself stays as it is
+    return evaluate(simplify_individual(individual, pset), *arguments)
+
+
+def simplify_and_trim(individual, trim, pset):
+    simplified_individual = simplify_individual(individual, pset)
+    if len(simplified_individual) == 1:  # the crossover needs a function node in both parents
+        return trim(individual)
+    return trim(simplified_individual)
+
+
+def register_simplification(toolbox, pset, simplify_evaluated_trees, simplify_genotypes):
+    # Wraps the registered evaluate and trim, so both evolution loops simplify without knowing about it
+    if simplify_evaluated_trees:
+        toolbox.register("evaluate", evaluate_simplified, evaluate=toolbox.evaluate, pset=pset)
+    if simplify_genotypes:
+        toolbox.register("trim", simplify_and_trim, trim=toolbox.trim, pset=pset)
+
+
+def get_node_depths(individual):
     stack = [0]
-    nodes = []
-    max_depth = 0
-    for i, elem in enumerate(individual):
-        if stack:  # Check if stack is not empty before popping
-            depth = stack.pop()
-            if height == depth:
-                nodes.append(i)
-            max_depth = max(max_depth, depth)
-            stack.extend([depth + 1] * elem.arity)
-        else:
-            break  # Exit the loop if stack is empty
-    return nodes
+    depths = []
+    for elem in individual:
+        depth = stack.pop()
+        depths.append(depth)
+        stack.extend([depth + 1] * elem.arity)
+    return depths
 
 
-def trim_individual(individual, max_tree_height, pset, csv_export, second_layer):
+def trim_individual(individual, max_tree_height, pset, csv_export):
+    global trimmed_tree_count
     try:
-        if second_layer:
-            individual = creator.Individual(gp.PrimitiveTree.from_string(str(individual),
-                                                      pset))  # We have to reparse it to get the real tree height
-        base_individual = individual
-        current_height = get_individual_height(individual)
-        list_individual = None
-        if current_height > max_tree_height:
-            indices = get_nodes_with_height(individual, max_tree_height)
-            list_individual = create_a_copy_of_individual_as_list(individual)
-            number_of_removed_nodes = 0
-            for i, index in enumerate(indices):
-                altered_index = index - number_of_removed_nodes
-                if isinstance(individual[index], deap.gp.Primitive):
-                    subtree_slice = individual.searchSubtree(index)
-                    start, end = subtree_slice.start, subtree_slice.stop
-                    range = end - start - 1
-                    number_of_removed_nodes = number_of_removed_nodes + range
-                    prune_start = altered_index + 1  # we dont want to remove the node we are changing for a terminal
-                    # Cut the individual from start to end by creating a copy of an individual and removing the parts from start to end
-                    list_individual = prune_subtree(list_individual, prune_start, prune_start + range)
-                    list_individual[altered_index] = random.choice(pset.terminals[object])
-        if list_individual is not None:  # needs trimming
-            individual = creator.Individual(list_individual)
-            csv_export.save_pruned_tree(base_individual)
+        depths = get_node_depths(individual)
+        if max(depths) > max_tree_height:
+            # Nodes below the maximum height are dropped, so one sweep cuts every over-height subtree at once
+            trimmed_nodes = []
+            for node, depth in zip(individual, depths):
+                if depth < max_tree_height or (depth == max_tree_height and node.arity == 0):
+                    trimmed_nodes.append(node)
+                elif depth == max_tree_height:
+                    trimmed_nodes.append(random.choice(pset.terminals[object]))
+            csv_export.save_pruned_tree(individual)
+            individual = creator.Individual(trimmed_nodes)
+            trimmed_tree_count += 1
     except:
         print("Exception in first layer generation loop")
         traceback.print_exc()
     return individual
 
 
-def create_a_copy_of_individual_as_list(individual):
-    list_individual = []
-    for elem in individual:
-        list_individual.append(elem)
-    return list_individual
-
-
-def prune_subtree(individual, start, end):
-    return individual[:start] + individual[end:]
-
-
 def koza_over_selection(individuals, k, tournsize, population_size):
     individuals = sorted(individuals, key=lambda x: x.fitness, reverse=True)
     fittest_individuals_percentage = (32000 / population_size) / 100
@@ -140,69 +145,251 @@ def koza_over_selection(individuals, k, tournsize, population_size):
         return selection.selTournament(rest_individuals, k, tournsize)
 
 
+def tarpeian_tournament(individuals, k, tournsize, tarpeian_probability):
+    # Poli's Tarpeian method applied in the selection: a random part of the trees above the average size counts as
+    # worse than every other individual
+    average_size = sum(len(individual) for individual in individuals) / len(individuals)
+    penalized = {id(individual) for individual in individuals
+                 if len(individual) > average_size and random.random() < tarpeian_probability}
+    chosen = []
+    for _ in range(k):
+        aspirants = selection.selRandom(individuals, tournsize)
+        chosen.append(max(aspirants, key=lambda individual: (id(individual) not in penalized, individual.fitness)))
+    return chosen
+
+
+def lexicographic_parsimony_tournament(individuals, k, tournsize):
+    chosen = []
+    for _ in range(k):
+        aspirants = selection.selRandom(individuals, tournsize)
+        chosen.append(max(aspirants, key=lambda individual: (individual.fitness, -len(individual))))
+    return chosen
+
+
+def register_selection(toolbox, selection_method, tournament_size):
+    if selection_method == DOUBLE_TOURNAMENT_SELECTION:
+        toolbox.register("select", tools.selDoubleTournament, fitness_size=tournament_size,
+                         parsimony_size=PARSIMONY_TOURNAMENT_SIZE, fitness_first=True)
+    elif selection_method == TARPEIAN_SELECTION:
+        toolbox.register("select", tarpeian_tournament, tournsize=tournament_size,
+                         tarpeian_probability=TARPEIAN_PROBABILITY)
+    elif selection_method == LEXICOGRAPHIC_PARSIMONY_SELECTION:
+        toolbox.register("select", lexicographic_parsimony_tournament, tournsize=tournament_size)
+    else:
+        toolbox.register("select", tools.selTournament, tournsize=tournament_size)
+
+
+def serialize_individuals(individuals):
+    # Compact form of evaluated individuals to send them between processes
+    return [(str(individual), individual.fitness.values) for individual in individuals]
+
+
+def deserialize_individuals(serialized_individuals, pset):
+    individuals = []
+    for expression, fitness_values in serialized_individuals:
+        individual = creator.Individual(gp.PrimitiveTree.from_string(expression, pset))
+        individual.fitness.values = fitness_values
+        individuals.append(individual)
+    return individuals
+
+
+def evaluate_individuals(toolbox, individuals, input_combinations):
+    if input_combinations is not None:  # only for first layer of two layer mux
+        fitnesses = toolbox.map(toolbox.evaluate, individuals, [input_combinations] * len(individuals))
+    else:
+        fitnesses = toolbox.map(toolbox.evaluate, individuals)
+    for ind, fit in zip(individuals, fitnesses):
+        ind.fitness.values = fit
+
+
+def replace_semantic_duplicates(toolbox, offspring, input_combinations):
+    # Offspring with the same outputs as an earlier offspring are replaced by new random trees to keep the diversity
+    arguments = [offspring] if input_combinations is None else [offspring, [input_combinations] * len(offspring)]
+    seen_semantics = set()
+    for i, semantics in enumerate(toolbox.map(toolbox.get_semantics, *arguments)):
+        if semantics in seen_semantics:
+            offspring[i] = toolbox.individual()
+        else:
+            seen_semantics.add(semantics)
+
+
+def evaluate_offspring(toolbox, offspring, input_combinations, population):
+    # Every tree structure is evaluated once, returns the number of evaluations
+    if hasattr(toolbox, "get_semantics"):
+        replace_semantic_duplicates(toolbox, offspring, input_combinations)
+    keys = [get_structural_key(individual) for individual in offspring]
+    unique_offspring = {}
+    for key, individual in zip(keys, offspring):
+        unique_offspring.setdefault(key, individual)
+    evaluate_unique_offspring(toolbox, list(unique_offspring.values()), input_combinations, population)
+    for key, individual in zip(keys, offspring):
+        individual.fitness.values = unique_offspring[key].fitness.values
+    return len(unique_offspring)
+
+
+def get_worst_possible_fitness(individual):
+    # No correct assessments for a maximized fitness, an infinite error for a minimized one
+    return 0.0 if individual.fitness.weights[0] > 0 else float('inf')
+
+
+def evaluate_unique_offspring(toolbox, offspring, input_combinations, population):
+    if not hasattr(toolbox, "evaluate_staged"):
+        evaluate_individuals(toolbox, offspring, input_combinations)
+        return
+    # Offspring that are worse than the whole population on a sample of the cases get the worst possible fitness
+    # instead of their real one. They lose every tournament against an evaluated individual, but tournaments among
+    # rejected ones are no longer decided by their real fitness, so staging changes the results of a run. The rejected
+    # individuals are left out of the threshold, it never gets looser.
+    evaluated_population = [individual for individual in population
+                            if individual.fitness.values[0] != get_worst_possible_fitness(individual)]
+    if len(evaluated_population) == 0:
+        evaluate_individuals(toolbox, offspring, input_combinations)
+        return
+    rejection_threshold = min(evaluated_population, key=lambda individual: individual.fitness).fitness.values[0]
+    arguments = [offspring]
+    if input_combinations is not None:  # only for first layer of two layer mux
+        arguments.append([input_combinations] * len(offspring))
+    arguments.append([rejection_threshold] * len(offspring))
+    fitnesses = toolbox.map(toolbox.evaluate_staged, *arguments)
+    for ind, fit in zip(offspring, fitnesses):
+        ind.fitness.values = fit
+
+
+def replace_worst_individuals(population, immigrants):
+    if len(immigrants) == 0:
+        return population
+    immigrants = immigrants[:len(population)]
+    population = sorted(population, key=lambda individual: individual.fitness, reverse=True)
+    return population[:len(population) - len(immigrants)] + immigrants
+
+
+def is_sampling_cases(toolbox):
+    return hasattr(toolbox, "sample_cases")
+
+
+def update_hall_of_fame(toolbox, hall_of_fame, population):
+    # With sampled cases the population only has the fitness on the cases of its generation, while the elites keep
+    # their fitness on all cases. The best individuals are scored on all cases before they are compared with the
+    # elites, so a lucky sample never pushes out a better elite. Returns the number of evaluations.
+    if not is_sampling_cases(toolbox):
+        hall_of_fame.update(population)
+        return 0
+    elite_keys = {get_structural_key(elite) for elite in hall_of_fame.items}
+    candidates = {}
+    for individual in sorted(population, key=lambda individual: individual.fitness, reverse=True):
+        key = get_structural_key(individual)
+        if key not in elite_keys and key not in candidates:
+            candidates[key] = toolbox.clone(individual)
+            if len(candidates) == hall_of_fame.maxsize:
+                break
+    for candidate in candidates.values():
+        candidate.fitness.values = toolbox.evaluate_all_cases(candidate)
+    hall_of_fame.update(list(candidates.values()))
+    return len(candidates)
+
+
+def select_best_individual(toolbox, population, hall_of_fame):
+    best_individual = tools.selBest(population, k=1)[0]
+    if is_sampling_cases(toolbox):
+        best_individual = toolbox.clone(best_individual)
+        best_individual.fitness.values = toolbox.evaluate_all_cases(best_individual)
+        # Both are scored on all cases, the best individual is never worse than the elite
+        if len(hall_of_fame) != 0 and hall_of_fame.items[0].fitness > best_individual.fitness:
+            best_individual = toolbox.clone(hall_of_fame.items[0])
+    return best_individual
+
+
+def is_solution_found(best_individual, algorithm_type, layer_number, number_of_layers, input_combinations):
+    if algorithm_type == "approximation":
+        return best_individual.fitness.values[0] == 0
+    if layer_number == 1 and number_of_layers == 2:
+        return best_individual.fitness.values[0] == len(input_combinations)
+    return best_individual.fitness.values[0] == 2048.0
+
+
 def gp_evolution(process_id, new_terminal_list, elites_size, population_size, number_of_generations,
                  crossover_probability, mutation_probability,
                  terminals_from_first_layer, toolbox, csv_exporter, layer_number, algorithm_type, process_address_map,
-                 number_of_layers):
+                 number_of_layers, migration=None, profile_generations=False, checkpoint=None,
+                 population_history=False):
     input_combinations = None
+    first_generation_number = 0
     try:
         hall_of_fame = tools.HallOfFame(maxsize=elites_size)
         population = toolbox.population(n=population_size)
         if algorithm_type == "MUX" and layer_number == 1 and number_of_layers == 2:
             input_combinations = generate_all_input_combinations_for_model(process_id, process_address_map)
-        if algorithm_type == "MUX" and layer_number == 1 and number_of_layers == 2:  # only do it for first layer of two layer mux
-            fitnesses = toolbox.map(toolbox.evaluate, population, [input_combinations] * len(population))
-            for ind, fit in zip(population, fitnesses):
-                ind.fitness.values = fit
+        if checkpoint is not None and checkpoint.exists():
+            # Continue an interrupted run, a finished one goes straight to the result
+            population, first_generation_number = checkpoint.resume(hall_of_fame)
         else:
-            fitnesses = toolbox.map(toolbox.evaluate, population)
-            for ind, fit in zip(population, fitnesses):
-                ind.fitness.values = fit
+            if is_sampling_cases(toolbox):
+                toolbox.sample_cases()
+            evaluate_individuals(toolbox, population, input_combinations)
     except:
         print("Error during initial population generation")
         traceback.print_exc()
 
-    for index in range(number_of_generations):
+    for index in range(first_generation_number, number_of_generations):
         try:
             print(str(process_id) + ": Generation " + str(index))
+            profile = GenerationProfile(process_id, layer_number, index) if profile_generations else None
 
-            offspring = toolbox.select(population, population_size)
+            with time_phase(profile, 'select'):
+                offspring = toolbox.select(population, population_size)
 
             # Genetic operations
-            offspring = algorithms.varAnd(offspring, toolbox, cxpb=crossover_probability,
-                                          mutpb=mutation_probability)  # perform only mutation + crossover
+            with time_phase(profile, 'variation'):
+                offspring = algorithms.varAnd(offspring, toolbox, cxpb=crossover_probability,
+                                              mutpb=mutation_probability)  # perform only mutation + crossover
             # Trimming
-            for i, individual in enumerate(offspring):
-                offspring[i] = toolbox.trim(individual)
+            with time_phase(profile, 'trim'):
+                trimmed_tree_count_before = trimmed_tree_count
+                for i, individual in enumerate(offspring):
+                    offspring[i] = toolbox.trim(individual)
+                # Counted where a tree is cut, a simplified genotype is a new tree as well
+                number_of_trimmed_trees = trimmed_tree_count - trimmed_tree_count_before
 
             # Need to manually evaluate the offspring
-            if algorithm_type == "MUX" and layer_number == 1 and number_of_layers == 2:  # only do it for first layer of two layer mux
-                fitnesses = toolbox.map(toolbox.evaluate, offspring, [input_combinations] * len(offspring))
-                for ind, fit in zip(offspring, fitnesses):
-                    ind.fitness.values = fit
-            else:
-                fitnesses = toolbox.map(toolbox.evaluate, offspring)
-                for ind, fit in zip(offspring, fitnesses):
-                    ind.fitness.values = fit
-
-            hall_of_fame.update(population)
-            elites = hall_of_fame.items
-            population[:] = offspring + elites
+            with time_phase(profile, 'evaluate'):
+                if is_sampling_cases(toolbox):
+                    toolbox.sample_cases()
+                number_of_evaluations = evaluate_offspring(toolbox, offspring, input_combinations, population)
+
+            with time_phase(profile, 'hall_of_fame'):
+                number_of_evaluations += update_hall_of_fame(toolbox, hall_of_fame, population)
+                elites = hall_of_fame.items
+                population[:] = offspring + elites
+            # Island model: exchange the best individuals with the other first layer processes
+            if migration is not None and migration.is_migration_generation(index):
+                with time_phase(profile, 'migration'):
+                    immigrants = migration.exchange(population)
+                    # the islands can have different cases
+                    evaluate_individuals(toolbox, immigrants, input_combinations)
+                    population[:] = replace_worst_individuals(population, immigrants)
+                number_of_evaluations += len(immigrants)
             # Save best individual
-            best_individual = tools.selBest(population, k=1)[0]
-            if process_id == 0:  # Only save the for process_id = 0 to avoid unnecessary delays
-                csv_exporter.save_best_individual_for_each_generation(best_individual, index, layer_number)
+            with time_phase(profile, 'export'):
+                best_individual = select_best_individual(toolbox, population, hall_of_fame)
+                if process_id == 0:  # Only save the for process_id = 0 to avoid unnecessary delays
+                    csv_exporter.save_best_individual_for_each_generation(best_individual, index, layer_number)
+                    if population_history:
+                        csv_exporter.save_whole_population_for_each_generation(population, index, layer_number)
+            if profile is not None:
+                profile.number_of_evaluations = number_of_evaluations
+                profile.number_of_trimmed_trees = number_of_trimmed_trees
+                profile.set_tree_statistics(offspring, get_individual_height)
+                csv_exporter.save_generation_profile(profile)
 
             # Break condition
-            if algorithm_type == "approximation":
-                if best_individual.fitness.values[0] == 0:
-                    break
-            else:
-                if layer_number == 1 and number_of_layers == 2 and best_individual.fitness.values[0] == len(
-                        input_combinations):
-                    break
-                elif best_individual.fitness.values[0] == 2048.0:
-                    break
+            solution_found = is_solution_found(best_individual, algorithm_type, layer_number, number_of_layers,
+                                               input_combinations)
+            if checkpoint is not None and (solution_found or
+                                           checkpoint.is_checkpoint_generation(index, number_of_generations)):
+                csv_exporter.flush()
+                checkpoint.save(number_of_generations if solution_found else index + 1, population, hall_of_fame)
+            if solution_found:
+                break
 
         except:
             if layer_number == 1:
@@ -213,11 +400,128 @@ def gp_evolution(process_id, new_terminal_list, elites_size, population_size, nu
 
     if terminals_from_first_layer != 0 and new_terminal_list is not None:
         if terminals_from_first_layer == 1:
-            new_terminal_list.append(tools.selBest(population, k=1)[0])
+            new_terminal_list.append(select_best_individual(toolbox, population, hall_of_fame))
         else:
+            if is_sampling_cases(toolbox):
+                for individual in population:
+                    individual.fitness.values = toolbox.evaluate_all_cases(individual)
             new_terminal_list += population
 
     if len(population) != 0:
-        best_current_individual = tools.selBest(population, k=1)[0]
+        best_current_individual = select_best_individual(toolbox, population, hall_of_fame)
+        print(f"Best individual: {best_current_individual}, Fitness: {best_current_individual.fitness.values[0]}")
+        return best_current_individual
+
+
+def create_child(population, toolbox, crossover_probability, mutation_probability):
+    parents = [toolbox.clone(individual) for individual in toolbox.select(population, 2)]
+    if random.random() < crossover_probability:
+        parents = toolbox.mate(parents[0], parents[1])
+    child = parents[0]
+    if random.random() < mutation_probability:
+        child, = toolbox.mutate(child)
+    del child.fitness.values
+    return toolbox.trim(child)
+
+
+def tournament_replacement(population, child, tournament_size):
+    # The loser of a tournament is replaced, but only by a better child, so the best individual is never lost
+    contestants = random.sample(range(len(population)), tournament_size)
+    loser_index = min(contestants, key=lambda index: population[index].fitness)
+    if child.fitness > population[loser_index].fitness:
+        population[loser_index] = child
+
+
+def gp_steady_state_evolution(process_id, new_terminal_list, elites_size, population_size, number_of_evaluations,
+                              crossover_probability, mutation_probability, terminals_from_first_layer, toolbox,
+                              csv_exporter, layer_number, algorithm_type, process_address_map, number_of_layers,
+                              evaluation_executor=None, evaluation_slots=1, replacement_tournament_size=2,
+                              population_history=False):
+    # Steady-state variant of gp_evolution: the budget is counted in evaluations and every evaluated child is inserted
+    # right away. With an evaluation_executor up to evaluation_slots children are evaluated at the same time, so there
+    # is no generation barrier waiting for the slowest individual. Every population_size evaluations count as one
+    # generation for the exports and the break condition.
+    # A process pool needs a picklable evaluator, so the executor runs toolbox.evaluate_in_worker if it is registered
+    # and reports every evaluation it finished to toolbox.count_evaluation.
+    input_combinations = None
+    population = []
+    hall_of_fame = tools.HallOfFame(maxsize=elites_size)
+    try:
+        population = toolbox.population(n=population_size)
+        if algorithm_type == "MUX" and layer_number == 1 and number_of_layers == 2:
+            input_combinations = generate_all_input_combinations_for_model(process_id, process_address_map)
+        evaluate_individuals(toolbox, population, input_combinations)
+        hall_of_fame.update(population)
+    except:
+        print("Error during initial population generation")
+        traceback.print_exc()
+
+    evaluation_arguments = [input_combinations] if input_combinations is not None else []
+    evaluate_remotely = toolbox.evaluate_in_worker if hasattr(toolbox, "evaluate_in_worker") else toolbox.evaluate
+    pending_evaluations = {}
+    submitted_evaluations = 0
+    finished_evaluations = 0
+    generation_number = 0
+    solution_found = False
+    try:
+        while finished_evaluations < number_of_evaluations and not solution_found:
+            if evaluation_executor is None:
+                child = create_child(population, toolbox, crossover_probability, mutation_probability)
+                child.fitness.values = toolbox.evaluate(child, *evaluation_arguments)
+                submitted_evaluations += 1
+                evaluated_children = [child]
+            else:
+                # Keep all the evaluation slots busy and continue with whichever child is evaluated first
+                while len(pending_evaluations) < evaluation_slots and submitted_evaluations < number_of_evaluations:
+                    child = create_child(population, toolbox, crossover_probability, mutation_probability)
+                    future = evaluation_executor.submit(evaluate_remotely, child, *evaluation_arguments)
+                    pending_evaluations[future] = child
+                    submitted_evaluations += 1
+                done, _ = concurrent.futures.wait(pending_evaluations, return_when=concurrent.futures.FIRST_COMPLETED)
+                evaluated_children = []
+                for future in done:
+                    child = pending_evaluations.pop(future)
+                    child.fitness.values = future.result()
+                    if hasattr(toolbox, "count_evaluation"):
+                        toolbox.count_evaluation()
+                    evaluated_children.append(child)
+
+            for child in evaluated_children:
+                tournament_replacement(population, child, replacement_tournament_size)
+                hall_of_fame.update([child])
+                finished_evaluations += 1
+                if finished_evaluations % population_size == 0:
+                    print(str(process_id) + ": Generation " + str(generation_number))
+                    best_individual = hall_of_fame.items[0]
+                    if process_id == 0:  # Only save the for process_id = 0 to avoid unnecessary delays
+                        csv_exporter.save_best_individual_for_each_generation(best_individual, generation_number,
+                                                                              layer_number)
+                        if population_history:
+                            csv_exporter.save_whole_population_for_each_generation(population, generation_number,
+                                                                                   layer_number)
+                    generation_number += 1
+                if is_solution_found(hall_of_fame.items[0], algorithm_type, layer_number, number_of_layers,
+                                     input_combinations):
+                    solution_found = True
+    except:
+        # A failed evaluation worker would otherwise end the run early with a partial result
+        if layer_number == 1:
+            print("Exception in first layer steady state loop")
+        else:
+            print("Exception in second layer steady state loop")
+        traceback.print_exc()
+        raise
+    finally:
+        for future in pending_evaluations:
+            future.cancel()
+
+    if terminals_from_first_layer != 0 and new_terminal_list is not None:
+        if terminals_from_first_layer == 1:
+            new_terminal_list.append(hall_of_fame.items[0])
+        else:
+            new_terminal_list += population
+
+    if len(hall_of_fame) != 0:
+        best_current_individual = hall_of_fame.items[0]
         print(f"Best individual: {best_current_individual}, Fitness: {best_current_individual.fitness.values[0]}")
         return best_current_individual
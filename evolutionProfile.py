@@ -0,0 +1,47 @@
+import contextlib
+import time
+
+PROFILED_PHASES = ('select', 'variation', 'trim', 'evaluate', 'hall_of_fame', 'migration', 'export')
+
+
+class GenerationProfile:
+    # Time spent in each phase of one gp_evolution generation and the counters of the generation, saved with
+    # CsvExporter.save_generation_profile
+
+    def __init__(self, process_id, layer_number, generation_number):
+        self.process_id = process_id
+        self.layer_number = layer_number
+        self.generation_number = generation_number
+        self.phase_seconds = dict.fromkeys(PROFILED_PHASES, 0.0)
+        self.number_of_evaluations = 0
+        self.number_of_trimmed_trees = 0
+        self.mean_tree_size = 0.0
+        self.mean_tree_height = 0.0
+
+    @contextlib.contextmanager
+    def time_phase(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_seconds[phase] += time.perf_counter() - start
+
+    def set_tree_statistics(self, individuals, get_height):
+        if len(individuals) > 0:
+            self.mean_tree_size = sum(len(individual) for individual in individuals) / len(individuals)
+            self.mean_tree_height = sum(get_height(individual) for individual in individuals) / len(individuals)
+
+    def as_record(self):
+        record = {'process_id': self.process_id, 'layer_number': self.layer_number,
+                  'generation_number': self.generation_number}
+        record.update({phase + '_seconds': seconds for phase, seconds in self.phase_seconds.items()})
+        record.update({'number_of_evaluations': self.number_of_evaluations,
+                       'number_of_trimmed_trees': self.number_of_trimmed_trees,
+                       'mean_tree_size': self.mean_tree_size, 'mean_tree_height': self.mean_tree_height})
+        return record
+
+
+def time_phase(profile, phase):
+    if profile is None:
+        return contextlib.nullcontext()
+    return profile.time_phase(phase)
@@ -0,0 +1,145 @@
+import csv
+import os
+import sqlite3
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from customLogic import get_individual_height
+
+EXPERIMENT_STORE_FILE_NAME = 'experiment.sqlite'
+BEST_INDIVIDUAL_RECORD = 0
+POPULATION_RECORD = 1
+RECORD_COLUMNS = ('run_number', 'layer_number', 'generation_number', 'record_type', 'expression_id', 'fitness',
+                  'height', 'size')
+
+
+class ExperimentStore:
+    # Append-only SQLite file holding the per-generation history of an experiment. Every distinct expression is
+    # saved once and referenced by id, the records are kept in memory and committed in one transaction on flush.
+    # Several processes can append to the same file, each of them opens its own connection.
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.__connection = None
+        self.__process_id = os.getpid()
+        self.__expression_ids = {}
+        self.__pending_records = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_ExperimentStore__connection'] = None
+        state['_ExperimentStore__pending_records'] = []
+        return state
+
+    def __check_process(self):
+        # A forked worker must neither reuse the connection of its parent nor commit the records of its parent
+        if self.__process_id != os.getpid():
+            self.__connection = None
+            self.__process_id = os.getpid()
+            self.__pending_records = []
+
+    def __get_connection(self):
+        self.__check_process()
+        if self.__connection is None:
+            self.__connection = sqlite3.connect(self.file_path, timeout=60, check_same_thread=False)
+            with self.__connection:
+                self.__connection.execute('PRAGMA journal_mode=WAL')
+                self.__connection.execute('CREATE TABLE IF NOT EXISTS expressions '
+                                          '(id INTEGER PRIMARY KEY, expression TEXT NOT NULL UNIQUE)')
+                self.__connection.execute('CREATE TABLE IF NOT EXISTS records (run_number INTEGER, '
+                                          'layer_number INTEGER, generation_number INTEGER, record_type INTEGER, '
+                                          'expression_id INTEGER, fitness REAL, height INTEGER, size INTEGER)')
+                self.__connection.execute('CREATE INDEX IF NOT EXISTS records_by_run_and_generation '
+                                          'ON records (run_number, generation_number)')
+        return self.__connection
+
+    def add_record(self, record_type, run_number, layer_number, generation_number, individual):
+        self.__check_process()
+        self.__pending_records.append((run_number, layer_number, generation_number, record_type, str(individual),
+                                       individual.fitness.values[0], get_individual_height(individual),
+                                       len(individual)))
+
+    def flush(self):
+        self.__check_process()
+        if not self.__pending_records:
+            return
+        connection = self.__get_connection()
+        with connection:
+            new_expressions = list(dict.fromkeys(record[4] for record in self.__pending_records
+                                                 if record[4] not in self.__expression_ids))
+            connection.executemany('INSERT OR IGNORE INTO expressions (expression) VALUES (?)',
+                                   ((expression,) for expression in new_expressions))
+            for expression in new_expressions:
+                self.__expression_ids[expression] = connection.execute(
+                    'SELECT id FROM expressions WHERE expression = ?', (expression,)).fetchone()[0]
+            connection.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (record[:4] + (self.__expression_ids[record[4]],) + record[5:]
+                                    for record in self.__pending_records))
+        self.__pending_records = []
+
+    def close(self):
+        self.flush()
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+
+    def get_records(self, run_number=None, record_type=BEST_INDIVIDUAL_RECORD):
+        # Returns the records as one NumPy array per column, in the order they were saved
+        query = f'SELECT {", ".join(RECORD_COLUMNS)} FROM records WHERE record_type = ?'
+        parameters = [record_type]
+        if run_number is not None:
+            query += ' AND run_number = ?'
+            parameters.append(run_number)
+        rows = self.__get_connection().execute(query + ' ORDER BY rowid', parameters).fetchall()
+        columns = list(zip(*rows)) if rows else [()] * len(RECORD_COLUMNS)
+        return {name: np.array(column) for name, column in zip(RECORD_COLUMNS, columns)}
+
+    def get_expressions(self, expression_ids):
+        expressions = dict(self.__get_connection().execute('SELECT id, expression FROM expressions').fetchall())
+        return [expressions[expression_id] for expression_id in expression_ids]
+
+    def export_to_csv(self, folder_name):
+        # Writes the history in the layout of CsvExporter.save_best_individual_for_each_generation and
+        # CsvExporter.save_whole_population_for_each_generation
+        self.flush()
+        rows = self.__get_connection().execute(
+            'SELECT record_type, run_number, layer_number, generation_number, expression, fitness, height '
+            'FROM records JOIN expressions ON expressions.id = records.expression_id ORDER BY records.rowid')
+        files = {}
+        last_population = None
+        try:
+            for record_type, run_number, layer_number, generation_number, expression, fitness, height in rows:
+                if record_type == BEST_INDIVIDUAL_RECORD:
+                    writer = self.__get_csv_writer(files, Path(folder_name) / str(layer_number) /
+                                                   'best_individual_generation.csv')
+                    if generation_number == 0:
+                        writer.writerow(['Generation Number', 'Individual', 'Fitness', 'Height'])
+                    writer.writerow([generation_number, expression, fitness, height])
+                else:
+                    writer = self.__get_csv_writer(files, Path(folder_name) / str(layer_number) / str(run_number) /
+                                                   f'population{generation_number}.csv')
+                    if last_population != (run_number, layer_number, generation_number):
+                        writer.writerow(['Individual', 'Fitness'])
+                        last_population = (run_number, layer_number, generation_number)
+                    writer.writerow([expression, fitness])
+        finally:
+            for file in files.values():
+                file.close()
+
+    @staticmethod
+    def __get_csv_writer(files, file_path):
+        # A file is written from the start when an export first uses it, so exporting again replaces the files
+        if file_path not in files:
+            Path(file_path.parent).mkdir(parents=True, exist_ok=True)
+            files[file_path] = open(file_path, 'w', newline='')
+        return csv.writer(files[file_path], delimiter=';')
+
+
+if __name__ == "__main__":
+    # Usage: python experimentStore.py <experiment folder>, writes the csv files next to the experiment store
+    experiment_folder = Path(sys.argv[1])
+    experiment_store = ExperimentStore(experiment_folder / EXPERIMENT_STORE_FILE_NAME)
+    experiment_store.export_to_csv(experiment_folder)
+    experiment_store.close()
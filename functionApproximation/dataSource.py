@@ -0,0 +1,99 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from gpInitialization import target_polynomial, X_RANGE, Y_RANGE, POINTS_FILE, TARGET_VALUES_FILE, \
+    EVALUATION_CHUNK_SIZE, DEFAULT_EVALUATION_CHUNK_SIZE
+
+
+class DataSource(ABC):
+    # Points and target values of the approximation that are read a chunk at a time instead of being held in memory.
+    # The indices of a chunk are a slice or a sorted array of point indices.
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    @abstractmethod
+    def get_chunk(self, indices):
+        # Returns the x values, y values and target values of the points with indices
+        pass
+
+    def iterate_chunks(self, point_indices, chunk_size):
+        # Yields x values, y values and target values of the points with point_indices, all the points if it is None,
+        # at most chunk_size points at a time. A chunk size of 0 reads DEFAULT_EVALUATION_CHUNK_SIZE points at a time,
+        # a data source is never read whole.
+        number_of_points = len(self) if point_indices is None else len(point_indices)
+        chunk_size = chunk_size if chunk_size > 0 else DEFAULT_EVALUATION_CHUNK_SIZE
+        for start in range(0, number_of_points, chunk_size):
+            end = min(start + chunk_size, number_of_points)
+            yield self.get_chunk(slice(start, end) if point_indices is None else point_indices[start:end])
+
+
+class GridDataSource(DataSource):
+    # The grid of x_range and y_range in the order of the flattened np.meshgrid(x_range, y_range), the points of a
+    # chunk are computed from their indices
+
+    def __init__(self, x_range, y_range):
+        self.x_range = np.asarray(x_range, dtype=float)
+        self.y_range = np.asarray(y_range, dtype=float)
+
+    def __len__(self):
+        return len(self.x_range) * len(self.y_range)
+
+    def get_chunk(self, indices):
+        if isinstance(indices, slice):
+            indices = np.arange(*indices.indices(len(self)))
+        x_values = self.x_range[indices % len(self.x_range)]
+        y_values = self.y_range[indices // len(self.x_range)]
+        return x_values, y_values, target_polynomial(x_values, y_values)
+
+
+class NpyDataSource(DataSource):
+    # Points from a .npy file with one (x, y) row per point, and their target values from a second .npy file or from
+    # target_polynomial. The files are memory-mapped, so all the processes share the pages cached by the operating
+    # system instead of holding their own copy.
+
+    def __init__(self, points_file, target_values_file=None):
+        self.points_file = points_file
+        self.target_values_file = target_values_file
+        self.__open_files()
+
+    def __getstate__(self):
+        # A worker maps the files again instead of receiving a copy of their content
+        return {'points_file': self.points_file, 'target_values_file': self.target_values_file}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__open_files()
+
+    def __open_files(self):
+        self.points = np.load(self.points_file, mmap_mode='r')
+        self.target_values = None
+        if self.target_values_file is not None:
+            self.target_values = np.load(self.target_values_file, mmap_mode='r')
+            if len(self.target_values) != len(self.points):
+                raise ValueError(f"{self.target_values_file} holds {len(self.target_values)} target values for "
+                                 f"{len(self.points)} points")
+
+    def __len__(self):
+        return len(self.points)
+
+    def get_chunk(self, indices):
+        points = np.asarray(self.points[indices], dtype=float)
+        x_values = points[:, 0]
+        y_values = points[:, 1]
+        if self.target_values is None:
+            return x_values, y_values, target_polynomial(x_values, y_values)
+        return x_values, y_values, np.asarray(self.target_values[indices], dtype=float)
+
+
+def load_points():
+    # Points of the first layer: the grid of X_RANGE and Y_RANGE as an array of (x, y) rows, or a data source that is
+    # evaluated in chunks if the points come from POINTS_FILE or EVALUATION_CHUNK_SIZE is set
+    if POINTS_FILE is not None:
+        return NpyDataSource(POINTS_FILE, TARGET_VALUES_FILE)
+    if EVALUATION_CHUNK_SIZE > 0:
+        return GridDataSource(X_RANGE, Y_RANGE)
+    x_grid, y_grid = np.meshgrid(X_RANGE, Y_RANGE)
+    return np.column_stack((x_grid.flatten(), y_grid.flatten()))
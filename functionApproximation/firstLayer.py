@@ -1,4 +1,7 @@
 import concurrent.futures
+import hashlib
+import random
+import sys
 from datetime import datetime
 
 import numpy as np
@@ -6,16 +9,36 @@ from deap import base, creator, tools, gp
 import traceback
 import multiprocessing
 
+from checkpoint import ExperimentCheckpoint, get_evolution_checkpoint
 from csvExport import CsvExporter
-from customLogic import koza_custom_two_point_crossover, trim_individual, gp_evolution
+from customLogic import koza_custom_two_point_crossover, trim_individual, gp_evolution, serialize_individuals, \
+    deserialize_individuals, register_simplification, register_selection, TOURNAMENT_SELECTION
+from dataSource import DataSource, load_points
 from gpInitialization import GpFirstLayerInitializer, GpSecondLayerInitializer, target_polynomial, LOWER_BOUND_X, \
-    UPPER_BOUND_X, LOWER_BOUND_Y, UPPER_BOUND_Y, STEP_SIZE_X, STEP_SIZE_Y, X_RANGE, Y_RANGE, NUMBER_OF_RUNS, \
-    MAX_TREE_HEIGHT
+    UPPER_BOUND_X, LOWER_BOUND_Y, UPPER_BOUND_Y, STEP_SIZE_X, STEP_SIZE_Y, NUMBER_OF_RUNS, \
+    MAX_TREE_HEIGHT, VECTORIZED_EVALUATION, SUBTREE_CACHE_SIZE_MB, BUFFERED_CSV_EXPORT, EXPERIMENT_STORE, \
+    PROFILE_EVOLUTION, SIMPLIFY_EVALUATED_TREES, SIMPLIFY_GENOTYPES, CHECKPOINT_INTERVAL, EVALUATION_CHUNK_SIZE, \
+    POINTS_FILE, TARGET_VALUES_FILE, POPULATION_HISTORY, get_grid_values
 from secondLayer import SecondLayer
+from islandModel import Migration, RING_TOPOLOGY
+from subtreeCache import SubtreeCache
+from treeCompiler import TreeCompiler
+from vectorizedEvaluation import evaluate_mse_vectorized, get_vectorized_context, \
+    evaluate_mse_with_subtree_cache, compute_output_vector, evaluate_mse_in_chunks, get_squared_error_sum_in_chunks
 
 BOOTSTRAPPING_PERCENTAGE = 100
+# Percentage of the points of a run drawn anew for every generation, the elites and the best individual are still
+# scored on all points. 100 evaluates every generation on all points.
+CASE_SAMPLING_PERCENTAGE = 100
+# Offspring are first scored on this percentage of the points and only evaluated on all of them if they can still be
+# better than the worst individual of the population. Rejected offspring get the worst possible fitness instead of
+# their real one, so a run gives different results than without staging.
+STAGED_EVALUATION = False
+STAGED_EVALUATION_SAMPLE_PERCENTAGE = 10
+REPLACE_SEMANTIC_DUPLICATES = False  # replace offspring with the same output vector as another one by random trees
 
 TOURNAMENT_SIZE = 2
+SELECTION_METHOD = TOURNAMENT_SELECTION
 ELITES_SIZE = 1
 NUMBER_OF_GENERATIONS = 3
 POPULATION_SIZE = 50
@@ -25,9 +48,14 @@ MAX_TREE_INIT_HEIGHT = 6
 TERMINALS_FROM_FIRST_LAYER = 1
 CROSSOVER_PROBABILITY = 0.9
 MUTATION_PROBABILITY = 0.01
+ISLAND_MODEL = False  # exchange the best individuals between the sub-model processes during the evolution
+MIGRATION_INTERVAL = 1  # number of generations between migrations
+MIGRATION_SIZE = 2  # number of best individuals sent to another island
+MIGRATION_TOPOLOGY = RING_TOPOLOGY
 
 first_layer_params = {
     'TOURNAMENT_SIZE': TOURNAMENT_SIZE,
+    'SELECTION_METHOD': SELECTION_METHOD,
     'ELITES_SIZE': ELITES_SIZE,
     'NUMBER_OF_GENERATIONS': NUMBER_OF_GENERATIONS,
     'POPULATION_SIZE': POPULATION_SIZE,
@@ -42,19 +70,97 @@ first_layer_params = {
     'STEP_SIZE_X': STEP_SIZE_X,
     'STEP_SIZE_Y': STEP_SIZE_Y,
     'BOOTSTRAPPING_PERCENTAGE': BOOTSTRAPPING_PERCENTAGE,
+    'CASE_SAMPLING_PERCENTAGE': CASE_SAMPLING_PERCENTAGE,
+    'STAGED_EVALUATION': STAGED_EVALUATION,
+    'STAGED_EVALUATION_SAMPLE_PERCENTAGE': STAGED_EVALUATION_SAMPLE_PERCENTAGE,
+    'REPLACE_SEMANTIC_DUPLICATES': REPLACE_SEMANTIC_DUPLICATES,
     'TERMINALS_FROM_FIRST_LAYER': TERMINALS_FROM_FIRST_LAYER,
     'CROSSOVER_PROBABILITY': CROSSOVER_PROBABILITY,
     'MUTATION_PROBABILITY': MUTATION_PROBABILITY,
+    'ISLAND_MODEL': ISLAND_MODEL,
+    'MIGRATION_INTERVAL': MIGRATION_INTERVAL,
+    'MIGRATION_SIZE': MIGRATION_SIZE,
+    'MIGRATION_TOPOLOGY': MIGRATION_TOPOLOGY,
+    'VECTORIZED_EVALUATION': VECTORIZED_EVALUATION,
+    'SUBTREE_CACHE_SIZE_MB': SUBTREE_CACHE_SIZE_MB,
+    'EVALUATION_CHUNK_SIZE': EVALUATION_CHUNK_SIZE,
+    'POINTS_FILE': POINTS_FILE,
+    'TARGET_VALUES_FILE': TARGET_VALUES_FILE,
 }
 
 
 class FirstLayer:
+    # grid_points is an array of (x, y) rows, or a DataSource whose points are read in chunks of
+    # EVALUATION_CHUNK_SIZE. With a data source only the indices of the evaluated points are kept, the trees are
+    # always evaluated on whole chunks and the subtree cache is not used.
 
     def __init__(self, pset, grid_points, csv_exporter):
         self.pset = pset
         self.toolbox = None
-        self.grid_points = self.__get_points_for_run(grid_points)
+        self.subtree_cache = SubtreeCache(SUBTREE_CACHE_SIZE_MB * 1024 * 1024) if SUBTREE_CACHE_SIZE_MB > 0 else None
+        self.tree_compiler = TreeCompiler(pset.context, pset.arguments, called_per_point=True)
+        self.vectorized_tree_compiler = TreeCompiler(get_vectorized_context(pset), pset.arguments)
+        self.set_points_for_run(grid_points)
         self.csv_exporter: CsvExporter = csv_exporter
+        self.number_of_approximations = 0
+
+    def set_points_for_run(self, grid_points):
+        if isinstance(grid_points, DataSource):
+            self.__set_data_source_for_run(grid_points)
+            return
+        self.data_source = None
+        self.grid_points = self.__get_points_for_run(grid_points)
+        self.all_target_values = target_polynomial(self.grid_points[:, 0], self.grid_points[:, 1])
+        self.__set_evaluated_points(self.grid_points)
+
+    def __set_evaluated_points(self, points):
+        self.evaluated_points = points
+        self.x_values = points[:, 0]
+        self.y_values = points[:, 1]
+        self.target_values = target_polynomial(self.x_values, self.y_values)
+        self.evaluation_context = get_vectorized_context(self.pset, (self.x_values, self.y_values))
+        # evenly spread points for the first stage of the staged evaluation
+        self.stage_points = points[::max(1, round(100 / STAGED_EVALUATION_SAMPLE_PERCENTAGE))]
+        self.stage_target_values = target_polynomial(self.stage_points[:, 0], self.stage_points[:, 1])
+        if self.subtree_cache is not None:  # the cached outputs belong to the previous points
+            self.subtree_cache.clear()
+
+    def __set_data_source_for_run(self, data_source):
+        self.data_source = data_source
+        self.run_point_indices = None  # all the points of the data source
+        if BOOTSTRAPPING_PERCENTAGE < 100:
+            amount_of_points = round(len(data_source) * (BOOTSTRAPPING_PERCENTAGE / 100))
+            # sorted, so a chunk reads close rows of a memory-mapped file
+            self.run_point_indices = np.sort(np.random.choice(len(data_source), size=amount_of_points, replace=False))
+        self.__set_evaluated_point_indices(self.run_point_indices)
+
+    def __set_evaluated_point_indices(self, point_indices):
+        self.evaluated_point_indices = point_indices
+        self.number_of_evaluated_points = len(self.data_source) if point_indices is None else len(point_indices)
+        # evenly spread points for the first stage of the staged evaluation
+        stage_step = max(1, round(100 / STAGED_EVALUATION_SAMPLE_PERCENTAGE))
+        self.stage_point_indices = (np.arange(0, self.number_of_evaluated_points, stage_step) if point_indices is None
+                                    else point_indices[::stage_step])
+
+    def __get_number_of_run_points(self):
+        if self.data_source is None:
+            return len(self.grid_points)
+        return len(self.data_source) if self.run_point_indices is None else len(self.run_point_indices)
+
+    def __iterate_chunks(self, point_indices):
+        return self.data_source.iterate_chunks(point_indices, EVALUATION_CHUNK_SIZE)
+
+    def sample_cases(self):
+        if self.data_source is not None:
+            amount_of_points = max(1, round(self.__get_number_of_run_points() * (CASE_SAMPLING_PERCENTAGE / 100)))
+            selected_indices = np.sort(np.random.choice(self.__get_number_of_run_points(), size=amount_of_points,
+                                                        replace=False))
+            self.__set_evaluated_point_indices(selected_indices if self.run_point_indices is None else
+                                               self.run_point_indices[selected_indices])
+            return
+        amount_of_points = max(1, round(len(self.grid_points) * (CASE_SAMPLING_PERCENTAGE / 100)))
+        selected_indices = np.random.choice(len(self.grid_points), size=amount_of_points, replace=False)
+        self.__set_evaluated_points(self.grid_points[selected_indices])
 
     def __get_points_for_run(self, new_grid_points):
         # retrieve a certain percentage of points from the original set based on BOOTSTRAPPING_PERCENTAGE
@@ -66,9 +172,9 @@ class FirstLayer:
     # Define the fitness measure, unused
     def __evaluate_individual(self, individual):
         try:
-            function = gp.compile(expr=individual, pset=self.pset)
+            function = self.tree_compiler.compile(individual)
             errors = []
-            for point in self.grid_points:
+            for point in self.evaluated_points:
                 x, y = point
                 individual_output = function(x, y)
                 error = abs(target_polynomial(x, y) - individual_output)
@@ -81,19 +187,96 @@ class FirstLayer:
 
     def evaluate_individual_mse(self, individual):
         try:
-            function = gp.compile(expr=individual, pset=self.pset)
+            function = self.tree_compiler.compile(individual)
             errors = []
-            for point in self.grid_points:
+            for point in self.evaluated_points:
                 x, y = point
                 individual_output = function(x, y)
                 error = pow(target_polynomial(x, y) - individual_output, 2)
                 errors.append(error)
             total_error = sum(errors) / len(errors)
+            self.number_of_approximations += 1
             return total_error,
         except Exception as e:
             print(f"Error during evaluation: {e}")
             return float('inf')
 
+    def evaluate_individual_mse_vectorized(self, individual):
+        try:
+            if self.data_source is not None:
+                function = self.vectorized_tree_compiler.compile(individual)
+                total_error = evaluate_mse_in_chunks(function, self.__iterate_chunks(self.evaluated_point_indices))
+            elif self.subtree_cache is not None:
+                total_error = evaluate_mse_with_subtree_cache(self.subtree_cache, individual, self.evaluation_context,
+                                                              self.target_values)
+            else:
+                function = self.vectorized_tree_compiler.compile(individual)
+                total_error = evaluate_mse_vectorized(function, self.x_values, self.y_values, self.target_values)
+            self.number_of_approximations += 1
+            return total_error,
+        except Exception as e:
+            print(f"Error during evaluation: {e}")
+            return float('inf'),
+
+    def get_semantics(self, individual):
+        if self.data_source is not None:
+            # a digest of the outputs, which are never all in memory
+            function = self.vectorized_tree_compiler.compile(individual)
+            output_digest = hashlib.blake2b()
+            with np.errstate(all='ignore'):
+                for x_values, y_values, _ in self.__iterate_chunks(self.evaluated_point_indices):
+                    output = function(x_values, y_values)
+                    output_digest.update(np.broadcast_to(np.asarray(output, dtype=float), x_values.shape).tobytes())
+            return output_digest.digest()
+        with np.errstate(all='ignore'):
+            if self.subtree_cache is not None:
+                output = self.subtree_cache.evaluate(individual, self.evaluation_context)
+            else:
+                output = self.vectorized_tree_compiler.compile(individual)(self.x_values, self.y_values)
+        return np.broadcast_to(np.asarray(output, dtype=float), self.x_values.shape).tobytes()
+
+    def evaluate_individual_staged(self, individual, rejection_threshold):
+        try:
+            if self.data_source is not None:
+                function = self.vectorized_tree_compiler.compile(individual)
+                stage_error_sum, _ = get_squared_error_sum_in_chunks(function,
+                                                                     self.__iterate_chunks(self.stage_point_indices))
+                number_of_evaluated_points = self.number_of_evaluated_points
+            elif VECTORIZED_EVALUATION:
+                function = self.vectorized_tree_compiler.compile(individual)
+                with np.errstate(all='ignore'):
+                    stage_output = function(self.stage_points[:, 0], self.stage_points[:, 1])
+                    stage_error_sum = float(np.sum(np.square(self.stage_target_values - stage_output)))
+                number_of_evaluated_points = len(self.evaluated_points)
+            else:
+                function = self.tree_compiler.compile(individual)
+                rejection_error_sum = rejection_threshold * len(self.evaluated_points)
+                stage_error_sum = 0
+                for (x, y), target_value in zip(self.stage_points, self.stage_target_values):
+                    stage_error_sum += pow(target_value - function(x, y), 2)
+                    if stage_error_sum > rejection_error_sum:  # the individual is already rejected
+                        break
+                number_of_evaluated_points = len(self.evaluated_points)
+            # The errors of the other points can only add to the sum, so this is a lower bound of the MSE
+            mse_lower_bound = stage_error_sum / number_of_evaluated_points
+            if np.isnan(mse_lower_bound) or mse_lower_bound > rejection_threshold:
+                return float('inf'),  # rejected, the worst possible fitness
+            return self.toolbox.evaluate(individual)
+        except Exception as e:
+            print(f"Error during evaluation: {e}")
+            return float('inf'),
+
+    def evaluate_individual_on_all_points(self, individual):
+        try:
+            function = self.vectorized_tree_compiler.compile(individual)
+            if self.data_source is not None:
+                return evaluate_mse_in_chunks(function, self.__iterate_chunks(self.run_point_indices)),
+            return evaluate_mse_vectorized(function, self.grid_points[:, 0], self.grid_points[:, 1],
+                                           self.all_target_values),
+        except Exception as e:
+            print(f"Error during evaluation: {e}")
+            return float('inf'),
+
     def initialize_toolbox(self):
         creator.create("FitnessMin", base.Fitness, weights=(-1.0,))
         creator.create("Individual", gp.PrimitiveTree, fitness=creator.FitnessMin, pset=self.pset)
@@ -104,60 +287,145 @@ class FirstLayer:
         self.toolbox.register("population", tools.initRepeat, list, self.toolbox.individual)
         self.toolbox.register("mate", koza_custom_two_point_crossover)
         self.toolbox.register("mutate", gp.mutNodeReplacement, pset=self.pset)
-        self.toolbox.register("evaluate", self.evaluate_individual_mse)
-        self.toolbox.register("select", tools.selTournament, tournsize=TOURNAMENT_SIZE)
+        if VECTORIZED_EVALUATION or self.data_source is not None:
+            self.toolbox.register("evaluate", self.evaluate_individual_mse_vectorized)
+        else:
+            self.toolbox.register("evaluate", self.evaluate_individual_mse)
+        if STAGED_EVALUATION:
+            self.toolbox.register("evaluate_staged", self.evaluate_individual_staged)
+        if REPLACE_SEMANTIC_DUPLICATES:
+            self.toolbox.register("get_semantics", self.get_semantics)
+        if CASE_SAMPLING_PERCENTAGE < 100:
+            self.toolbox.register("sample_cases", self.sample_cases)
+            self.toolbox.register("evaluate_all_cases", self.evaluate_individual_on_all_points)
+        register_selection(self.toolbox, SELECTION_METHOD, TOURNAMENT_SIZE)
         self.toolbox.register("trim", trim_individual, max_tree_height=MAX_TREE_HEIGHT, pset=self.pset,
-                              csv_export=self.csv_exporter, second_layer=False)
+                              csv_export=self.csv_exporter)
+        register_simplification(self.toolbox, self.pset, SIMPLIFY_EVALUATED_TREES, SIMPLIFY_GENOTYPES)
+
+
+# State of a process in the persistent worker pool, loaded once per experiment by initialize_worker
+worker_state = {}
+
+
+def initialize_worker(pset, grid_points, csv_exporter, migration_inboxes):
+    first_layer_instance = FirstLayer(pset, grid_points, csv_exporter)
+    first_layer_instance.initialize_toolbox()
+    worker_state['first_layer_instance'] = first_layer_instance
+    worker_state['migration_inboxes'] = migration_inboxes
+    worker_state['grid_points'] = grid_points
+    worker_state['run_number'] = None
+
+
+def evolve_sub_model(run_number, run_seed, process_id, seed):
+    first_layer_instance = worker_state['first_layer_instance']
+    if worker_state['run_number'] != run_number:
+        # All the sub-models of a run have to see the same points, so they are drawn with the seed of the run
+        np.random.seed(run_seed)
+        first_layer_instance.set_points_for_run(worker_state['grid_points'])
+        worker_state['run_number'] = run_number
+    random.seed(seed)
+    np.random.seed(seed)
+    first_layer_instance.csv_exporter.set_run_number(run_number)
+    migration = get_migration(process_id, run_number)
+    checkpoint = get_evolution_checkpoint(first_layer_instance.csv_exporter, 1, process_id, CHECKPOINT_INTERVAL)
+    sub_models = []
+    gp_evolution(process_id, sub_models, ELITES_SIZE, POPULATION_SIZE, NUMBER_OF_GENERATIONS,
+                 CROSSOVER_PROBABILITY, MUTATION_PROBABILITY, TERMINALS_FROM_FIRST_LAYER,
+                 first_layer_instance.toolbox, first_layer_instance.csv_exporter, 1, "approximation", None, 2,
+                 migration, PROFILE_EVOLUTION, checkpoint, POPULATION_HISTORY)
+    first_layer_instance.csv_exporter.flush()
+    return serialize_individuals(sub_models)
+
+
+def execute_run(run_number, pset, csv_exporter, executor=None):
+    # Evolves the sub-models of one run in the pool of executor, or one after the other in this process if there is
+    # none, and the second layer on their outputs. Returns the best individual of the second layer.
+    run_seed = random.randrange(2 ** 32)
+    sub_model_arguments = [(run_number, run_seed, process_id, random.randrange(2 ** 32))
+                           for process_id in range(NUMBER_OF_SUB_MODELS)]
+    if executor is None:
+        serialized_sub_models = [evolve_sub_model(*arguments) for arguments in sub_model_arguments]
+    else:
+        futures = [executor.submit(evolve_sub_model, *arguments) for arguments in sub_model_arguments]
+        serialized_sub_models = [future.result() for future in futures]
+    # Sub-models come back in process order as expressions with their fitness
+    new_terminals = []
+    for serialized_sub_model in serialized_sub_models:
+        new_terminals += deserialize_individuals(serialized_sub_model, pset)
+    csv_exporter.save_sub_models(new_terminals, run_number)
+    # Each distinct sub-model becomes a terminal holding its output over the second layer grid, named after its row
+    # in the sub_models csv
+    second_layer_x_values, second_layer_y_values = get_grid_values()
+    terminal_map = {}
+    sub_model_expressions = set()
+    best_fitness = float("inf")
+    best_individual = None
+    for i, terminal in enumerate(new_terminals):
+        if str(terminal) not in sub_model_expressions:
+            sub_model_expressions.add(str(terminal))
+            terminal_map[f'sub_model_{i}'] = compute_output_vector(terminal, pset, second_layer_x_values,
+                                                                   second_layer_y_values)
+        if best_fitness > terminal.fitness.values[0]:
+            best_fitness = terminal.fitness.values[0]
+            best_individual = terminal
+
+    print("Best fitness from first layer: " + str(best_fitness))
+    print("---------Second layer---------")
+
+    gp_second_layer_initializer = GpSecondLayerInitializer(terminal_map)
+    gp_second_layer_initializer.initialize_gp_run()
+    second_layer = SecondLayer(pset, gp_second_layer_initializer.pset,
+                               gp_second_layer_initializer.pset_without_first_layer_terminals, csv_exporter)
+    if run_number == 0:
+        csv_exporter.export_run_params_to_csv(first_layer_params, second_layer.second_layer_params)
+    best_overall_individual = second_layer.execute_run(get_evolution_checkpoint(csv_exporter, 2, 0,
+                                                                                CHECKPOINT_INTERVAL))
+    csv_exporter.save_best_individual(best_overall_individual, run_number)
+    return best_overall_individual
+
+
+def load_points_of_both_layers():
+    # The second layer evaluates the sub-models on the grid of get_grid_values against target_polynomial, so the first
+    # layer has to be evolved on the same grid, in memory or in chunks of a GridDataSource
+    if POINTS_FILE is not None:
+        raise ValueError("POINTS_FILE is not supported with two layers, the second layer is evaluated on the grid of "
+                         "X_RANGE and Y_RANGE. Use completePlainGp/plainGp.py to evolve a single layer on its points.")
+    return load_points()
+
+
+def get_migration(process_id, run_number):
+    if not ISLAND_MODEL:
+        return None
+    return Migration(process_id, run_number, worker_state['migration_inboxes'],
+                     worker_state['first_layer_instance'].pset, MIGRATION_INTERVAL, MIGRATION_SIZE, MIGRATION_TOPOLOGY)
 
 
 if __name__ == "__main__":
+    # Usage: python firstLayer.py [<experiment folder>], passing the folder of an interrupted experiment resumes it
     try:
         now = datetime.now()
-        csv_exporter = CsvExporter(now)
-        manager = multiprocessing.Manager()
+        csv_exporter = CsvExporter(now, BUFFERED_CSV_EXPORT, EXPERIMENT_STORE,
+                                   sys.argv[1] if len(sys.argv) > 1 else None)
+        experiment_checkpoint = ExperimentCheckpoint(csv_exporter.folder_name)
         gp_first_layer_initializer = GpFirstLayerInitializer()
         gp_first_layer_initializer.initialize_gp_run()
-        X, Y = np.meshgrid(X_RANGE, Y_RANGE)
-        grid_points = np.column_stack((X.flatten(), Y.flatten()))
-        for run_number in range(NUMBER_OF_RUNS):
-            print("Starting run " + str(run_number))
-            new_terminals = manager.list()
-            first_layer_instance = FirstLayer(gp_first_layer_initializer.pset, grid_points, csv_exporter)
-            first_layer_instance.initialize_toolbox()
-            print("toolbox init")
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                futures = [executor.submit(gp_evolution, process_id, new_terminals, ELITES_SIZE, POPULATION_SIZE,
-                                           NUMBER_OF_GENERATIONS, CROSSOVER_PROBABILITY,
-                                           MUTATION_PROBABILITY, TERMINALS_FROM_FIRST_LAYER,
-                                           first_layer_instance.toolbox, first_layer_instance.csv_exporter, 1,
-                                           "approximation", None, 2) for
-                           process_id
-                           in
-                           range(NUMBER_OF_SUB_MODELS)]
-            concurrent.futures.wait(futures)
-            csv_exporter.save_sub_models(new_terminals, run_number)
-            functions = []
-            terminal_map = {}
-            best_fitness = float("inf")
-            best_individual = None
-            for i, terminal in enumerate(new_terminals):
-                terminal_name = f'{terminal}'
-                terminal_map[terminal_name] = terminal
-                if best_fitness > terminal.fitness.values[0]:
-                    best_fitness = terminal.fitness.values[0]
-                    best_individual = terminal
-
-            print("Best fitness from first layer: " + str(best_fitness))
-            print("---------Second layer---------")
-
-            gp_second_layer_initializer = GpSecondLayerInitializer(terminal_map)
-            gp_second_layer_initializer.initialize_gp_run()
-            second_layer = SecondLayer(gp_first_layer_initializer.pset, gp_second_layer_initializer.pset,
-                                       gp_second_layer_initializer.pset_without_first_layer_terminals, csv_exporter)
-            if run_number == 0:
-                csv_exporter.export_run_params_to_csv(first_layer_params, second_layer.second_layer_params)
-            best_overall_individual = second_layer.execute_run()
-            csv_exporter.save_best_individual(best_overall_individual, run_number)
+        grid_points = load_points_of_both_layers()
+        # The creator classes are needed in this process as well to receive the sub-models
+        FirstLayer(gp_first_layer_initializer.pset, grid_points, csv_exporter).initialize_toolbox()
+        # The inboxes of the islands are handed to the workers when the pool starts and reused for all the runs
+        migration_inboxes = [multiprocessing.Queue() for _ in range(NUMBER_OF_SUB_MODELS)] if ISLAND_MODEL else None
+        # One pool for the whole experiment, every worker loads the pset, grid and toolbox only once
+        with concurrent.futures.ProcessPoolExecutor(initializer=initialize_worker,
+                                                    initargs=(gp_first_layer_initializer.pset, grid_points,
+                                                              csv_exporter, migration_inboxes)) as executor:
+            for run_number in range(experiment_checkpoint.resume(), NUMBER_OF_RUNS):
+                print("Starting run " + str(run_number))
+                csv_exporter.set_run_number(run_number)
+                execute_run(run_number, gp_first_layer_initializer.pset, csv_exporter, executor)
+                csv_exporter.flush()
+                if CHECKPOINT_INTERVAL > 0:
+                    experiment_checkpoint.save(run_number)
     except:
         traceback.print_exc()
 
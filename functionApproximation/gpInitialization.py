@@ -16,12 +16,34 @@ X_RANGE = np.arange(LOWER_BOUND_X, UPPER_BOUND_X + STEP_SIZE_X, STEP_SIZE_X)
 Y_RANGE = np.arange(LOWER_BOUND_Y, UPPER_BOUND_Y + STEP_SIZE_Y, STEP_SIZE_Y)
 NUMBER_OF_RUNS = 500
 MAX_TREE_HEIGHT = 17
+VECTORIZED_EVALUATION = True  # evaluate each tree once over the whole grid instead of point by point
+SUBTREE_CACHE_SIZE_MB = 32  # memory for caching subtree outputs of the vectorized evaluation, 0 disables the cache
+# Number of points the first layer evaluates at once, reading them from a data source instead of holding the points
+# of a run in memory. 0 keeps them in memory unless they come from POINTS_FILE, which is then read in chunks of
+# DEFAULT_EVALUATION_CHUNK_SIZE points.
+EVALUATION_CHUNK_SIZE = 0
+DEFAULT_EVALUATION_CHUNK_SIZE = 65536
+POINTS_FILE = None  # .npy file with one (x, y) row per point, memory-mapped and used instead of the grid
+TARGET_VALUES_FILE = None  # .npy file with the target value of every row of POINTS_FILE, else target_polynomial
+BUFFERED_CSV_EXPORT = True  # write the csv files from a background thread, flushed after every run
+EXPERIMENT_STORE = False  # keep the per-generation history in experiment.sqlite instead of csv files
+POPULATION_HISTORY = False  # save the whole population of every generation, not only its best individual
+PROFILE_EVOLUTION = False  # save the time of each phase and the counters of every generation
+CHECKPOINT_INTERVAL = 10  # generations between the checkpoints of a run, 0 disables checkpoints
+SIMPLIFY_EVALUATED_TREES = False  # fold constants and remove identities before evaluating, the genotype stays as it is
+SIMPLIFY_GENOTYPES = False  # replace the offspring by their simplified trees before trimming
 
 
 def target_polynomial(x, y):
     return (x * y) * (y - x)
 
 
+def get_grid_values():
+    # Points ordered the same way as iterating X_RANGE in the outer and Y_RANGE in the inner loop
+    x_grid, y_grid = np.meshgrid(X_RANGE, Y_RANGE, indexing='ij')
+    return x_grid.flatten(), y_grid.flatten()
+
+
 class GpFirstLayerInitializer:
 
     def __init__(self):
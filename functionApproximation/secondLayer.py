@@ -1,11 +1,18 @@
 from deap import gp, creator, base, tools
 
-from customLogic import koza_custom_two_point_crossover, trim_individual, gp_evolution
-from gpInitialization import target_polynomial, X_RANGE, Y_RANGE, MAX_TREE_HEIGHT
+from customLogic import koza_custom_two_point_crossover, trim_individual, gp_evolution, register_simplification, \
+    register_selection, TOURNAMENT_SELECTION
+from gpInitialization import target_polynomial, MAX_TREE_HEIGHT, SUBTREE_CACHE_SIZE_MB, PROFILE_EVOLUTION, \
+    SIMPLIFY_EVALUATED_TREES, SIMPLIFY_GENOTYPES, POPULATION_HISTORY, get_grid_values
+from subtreeCache import SubtreeCache
+from treeCompiler import TreeCompiler
+from vectorizedEvaluation import evaluate_mse_vectorized, get_vectorized_context, \
+    evaluate_mse_with_subtree_cache
 
 
 class SecondLayer:
     TOURNAMENT_SIZE = 2
+    SELECTION_METHOD = TOURNAMENT_SELECTION
     ELITES_SIZE = 1
     NUMBER_OF_GENERATIONS = 10
     POPULATION_SIZE = 200
@@ -16,6 +23,7 @@ class SecondLayer:
 
     second_layer_params = {
         'TOURNAMENT_SIZE': TOURNAMENT_SIZE,
+        'SELECTION_METHOD': SELECTION_METHOD,
         'ELITES_SIZE': ELITES_SIZE,
         'NUMBER_OF_GENERATIONS': NUMBER_OF_GENERATIONS,
         'POPULATION_SIZE': POPULATION_SIZE,
@@ -34,39 +42,23 @@ class SecondLayer:
         self.second_layer_pset_without_terminals_from_first_layer = second_layer_pset_without_terminals_from_first_layer
         self.number_of_approximations = 0
         self.csv_exporter = csv_exporter
+        self.x_values, self.y_values = get_grid_values()
+        self.target_values = target_polynomial(self.x_values, self.y_values)
+        self.evaluation_context = get_vectorized_context(self.pset, (self.x_values, self.y_values))
+        self.subtree_cache = SubtreeCache(SUBTREE_CACHE_SIZE_MB * 1024 * 1024) if SUBTREE_CACHE_SIZE_MB > 0 else None
+        self.vectorized_tree_compiler = TreeCompiler(get_vectorized_context(self.pset), self.pset.arguments)
 
-    # Define the fitness measure
-    def __evaluate_individual(self, individual):
+    # Define the fitness measure. Sub-models from the first layer are terminals holding their precomputed output over
+    # the grid, so the second layer is always evaluated on whole vectors instead of point by point
+    def __evaluate_individual_mse_vectorized(self, individual):
         try:
-            compiled_individual = gp.compile(expr=individual, pset=self.pset)
-
-            x_values = X_RANGE
-            y_values = Y_RANGE
-            errors = []
-            for x in x_values:
-                for y in y_values:
-                    individual_output = compiled_individual(x, y)
-                    error = abs(target_polynomial(x, y) - individual_output)
-                    errors.append(error)
-            total_error = sum(errors)
-            return total_error,
-        except Exception as e:
-            print(f"Error during evaluation: {e}")
-            return float('inf'),  # Return a high fitness in case of an error
-
-    def __evaluate_individual_mse(self, individual):
-        try:
-            compiled_individual = gp.compile(expr=individual, pset=self.pset)
-
-            x_values = X_RANGE
-            y_values = Y_RANGE
-            errors = []
-            for x in x_values:
-                for y in y_values:
-                    individual_output = compiled_individual(x, y)
-                    error = pow(target_polynomial(x, y) - individual_output, 2)
-                    errors.append(error)
-            total_error = sum(errors) / len(errors)
+            if self.subtree_cache is not None:
+                total_error = evaluate_mse_with_subtree_cache(self.subtree_cache, individual, self.evaluation_context,
+                                                              self.target_values)
+            else:
+                compiled_individual = self.vectorized_tree_compiler.compile(individual)
+                total_error = evaluate_mse_vectorized(compiled_individual, self.x_values, self.y_values,
+                                                      self.target_values)
             self.number_of_approximations += 1
             return total_error,
         except Exception as e:
@@ -83,17 +75,19 @@ class SecondLayer:
         toolbox.register("individual", tools.initIterate, creator.Individual2, toolbox.expr)
 
         toolbox.register("population", tools.initRepeat, list, toolbox.individual)
-        toolbox.register("evaluate", self.__evaluate_individual_mse)
+        toolbox.register("evaluate", self.__evaluate_individual_mse_vectorized)
         toolbox.register("mate", koza_custom_two_point_crossover)
         toolbox.register("trim", trim_individual, max_tree_height=MAX_TREE_HEIGHT,
                          pset=self.second_layer_pset_without_terminals_from_first_layer,
-                         csv_export=self.csv_exporter, second_layer=True)
+                         csv_export=self.csv_exporter)
+        register_simplification(toolbox, self.pset, SIMPLIFY_EVALUATED_TREES, SIMPLIFY_GENOTYPES)
         toolbox.register("mutate", gp.mutNodeReplacement, pset=self.pset)
-        toolbox.register("select", tools.selTournament, tournsize=self.TOURNAMENT_SIZE)
+        register_selection(toolbox, self.SELECTION_METHOD, self.TOURNAMENT_SIZE)
         return toolbox
 
-    def execute_run(self):
+    def execute_run(self, checkpoint=None):
         toolbox = self.__prepare_run()
         return gp_evolution(0, None, self.ELITES_SIZE, self.POPULATION_SIZE, self.NUMBER_OF_GENERATIONS,
                             self.CROSSOVER_PROBABILITY, self.MUTATION_PROBABILITY, 0, toolbox, self.csv_exporter, 2,
-                            "approximation", None, 2)
+                            "approximation", None, 2, profile_generations=PROFILE_EVOLUTION, checkpoint=checkpoint,
+                            population_history=POPULATION_HISTORY)
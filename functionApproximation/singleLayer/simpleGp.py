@@ -1,17 +1,28 @@
+import concurrent.futures
+import os
+import random
 from datetime import datetime
 
 import numpy as np
 from deap import base, creator, tools, gp
 import traceback
-import multiprocessing
 
 from csvExport import CsvExporter
-from customLogic import koza_custom_two_point_crossover, trim_individual, gp_evolution
+from customLogic import koza_custom_two_point_crossover, trim_individual, gp_evolution, serialize_individuals, \
+    deserialize_individuals, gp_steady_state_evolution, register_simplification, register_selection, \
+    TOURNAMENT_SELECTION
 from functionApproximation.gpInitialization import MAX_TREE_HEIGHT, LOWER_BOUND_X, UPPER_BOUND_X, LOWER_BOUND_Y, \
     UPPER_BOUND_Y, STEP_SIZE_X, STEP_SIZE_Y, target_polynomial, NUMBER_OF_RUNS, X_RANGE, Y_RANGE, \
-    GpFirstLayerInitializer
+    GpFirstLayerInitializer, VECTORIZED_EVALUATION, SUBTREE_CACHE_SIZE_MB, BUFFERED_CSV_EXPORT, EXPERIMENT_STORE, \
+    PROFILE_EVOLUTION, SIMPLIFY_EVALUATED_TREES, SIMPLIFY_GENOTYPES, POPULATION_HISTORY
+from runScheduler import CsvExportRecorder, schedule_runs, replay_csv_export_calls
+from subtreeCache import SubtreeCache
+from treeCompiler import TreeCompiler
+from vectorizedEvaluation import evaluate_mse_vectorized, get_vectorized_context, \
+    evaluate_mse_with_subtree_cache
 
 TOURNAMENT_SIZE = 2
+SELECTION_METHOD = TOURNAMENT_SELECTION
 ELITES_SIZE = 1
 NUMBER_OF_GENERATIONS = 100
 POPULATION_SIZE = 200
@@ -20,10 +31,16 @@ MAX_TREE_INIT_HEIGHT = 6
 TERMINALS_FROM_FIRST_LAYER = 1
 CROSSOVER_PROBABILITY = 0.9
 MUTATION_PROBABILITY = 0.01
+STEADY_STATE_EVOLUTION = False  # insert every evaluated child right away instead of replacing whole generations
+NUMBER_OF_EVALUATIONS = POPULATION_SIZE * NUMBER_OF_GENERATIONS  # budget of the steady-state evolution
+# Processes evaluating the children of a steady-state run at the same time, 0 evaluates them one by one in the
+# process of the run
+STEADY_STATE_EVALUATION_WORKERS = 0
 
 
 first_layer_params = {
     'TOURNAMENT_SIZE': TOURNAMENT_SIZE,
+    'SELECTION_METHOD': SELECTION_METHOD,
     'ELITES_SIZE': ELITES_SIZE,
     'NUMBER_OF_GENERATIONS': NUMBER_OF_GENERATIONS,
     'POPULATION_SIZE': POPULATION_SIZE,
@@ -39,6 +56,11 @@ first_layer_params = {
     'TERMINALS_FROM_FIRST_LAYER': TERMINALS_FROM_FIRST_LAYER,
     'CROSSOVER_PROBABILITY': CROSSOVER_PROBABILITY,
     'MUTATION_PROBABILITY': MUTATION_PROBABILITY,
+    'STEADY_STATE_EVOLUTION': STEADY_STATE_EVOLUTION,
+    'NUMBER_OF_EVALUATIONS': NUMBER_OF_EVALUATIONS,
+    'STEADY_STATE_EVALUATION_WORKERS': STEADY_STATE_EVALUATION_WORKERS,
+    'VECTORIZED_EVALUATION': VECTORIZED_EVALUATION,
+    'SUBTREE_CACHE_SIZE_MB': SUBTREE_CACHE_SIZE_MB,
 }
 
 
@@ -48,13 +70,20 @@ class FirstLayer:
         self.pset = pset
         self.toolbox = None
         self.grid_points = grid_points
+        self.x_values = self.grid_points[:, 0]
+        self.y_values = self.grid_points[:, 1]
+        self.target_values = target_polynomial(self.x_values, self.y_values)
+        self.evaluation_context = get_vectorized_context(pset, (self.x_values, self.y_values))
+        self.subtree_cache = SubtreeCache(SUBTREE_CACHE_SIZE_MB * 1024 * 1024) if SUBTREE_CACHE_SIZE_MB > 0 else None
+        self.tree_compiler = TreeCompiler(pset.context, pset.arguments, called_per_point=True)
+        self.vectorized_tree_compiler = TreeCompiler(get_vectorized_context(pset), pset.arguments)
         self.csv_exporter: CsvExporter = csv_exporter
         self.number_of_approximations = 0
 
     # Define the fitness measure, unused
     def __evaluate_individual(self, individual):
         try:
-            function = gp.compile(expr=individual, pset=self.pset)
+            function = self.tree_compiler.compile(individual)
             errors = []
             for point in self.grid_points:
                 x, y = point
@@ -69,7 +98,7 @@ class FirstLayer:
 
     def __evaluate_individual_mse(self, individual):
         try:
-            function = gp.compile(expr=individual, pset=self.pset)
+            function = self.tree_compiler.compile(individual)
             errors = []
             for point in self.grid_points:
                 x, y = point
@@ -83,6 +112,23 @@ class FirstLayer:
             print(f"Error during evaluation: {e}")
             return float('inf')
 
+    def __evaluate_individual_mse_vectorized(self, individual):
+        try:
+            if self.subtree_cache is not None:
+                total_error = evaluate_mse_with_subtree_cache(self.subtree_cache, individual, self.evaluation_context,
+                                                              self.target_values)
+            else:
+                function = self.vectorized_tree_compiler.compile(individual)
+                total_error = evaluate_mse_vectorized(function, self.x_values, self.y_values, self.target_values)
+            self.number_of_approximations += 1
+            return total_error,
+        except Exception as e:
+            print(f"Error during evaluation: {e}")
+            return float('inf'),
+
+    def count_evaluation(self):
+        self.number_of_approximations += 1
+
     def initialize_toolbox(self):
         creator.create("FitnessMin", base.Fitness, weights=(-1.0,))
         creator.create("Individual", gp.PrimitiveTree, fitness=creator.FitnessMin, pset=self.pset)
@@ -93,31 +139,99 @@ class FirstLayer:
         self.toolbox.register("population", tools.initRepeat, list, self.toolbox.individual)
         self.toolbox.register("mate", koza_custom_two_point_crossover)
         self.toolbox.register("mutate", gp.mutNodeReplacement, pset=self.pset)
-        self.toolbox.register("evaluate", self.__evaluate_individual_mse)
-        self.toolbox.register("select", tools.selTournament, tournsize=TOURNAMENT_SIZE)
+        if VECTORIZED_EVALUATION:
+            self.toolbox.register("evaluate", self.__evaluate_individual_mse_vectorized)
+        else:
+            self.toolbox.register("evaluate", self.__evaluate_individual_mse)
+        register_selection(self.toolbox, SELECTION_METHOD, TOURNAMENT_SIZE)
         self.toolbox.register("trim", trim_individual, max_tree_height=MAX_TREE_HEIGHT, pset=self.pset,
-                              csv_export=self.csv_exporter, second_layer=False)
+                              csv_export=self.csv_exporter)
+        register_simplification(self.toolbox, self.pset, SIMPLIFY_EVALUATED_TREES, SIMPLIFY_GENOTYPES)
+        if STEADY_STATE_EVALUATION_WORKERS > 0:
+            # The evaluation pool receives a module function instead of this instance
+            self.toolbox.register("evaluate_in_worker", evaluate_in_worker)
+            self.toolbox.register("count_evaluation", self.count_evaluation)
+
+
+# State of a process in the run scheduler pool, loaded once by initialize_worker
+worker_state = {}
+
+
+def initialize_worker(pset, grid_points):
+    csv_export_recorder = CsvExportRecorder()
+    first_layer_instance = FirstLayer(pset, grid_points, csv_export_recorder)
+    first_layer_instance.initialize_toolbox()
+    worker_state['first_layer_instance'] = first_layer_instance
+    worker_state['csv_export_recorder'] = csv_export_recorder
+
+
+def evaluate_in_worker(individual, *args):
+    # Evaluates a child of a steady-state run in a process of the evaluation pool
+    return worker_state['first_layer_instance'].toolbox.evaluate(individual, *args)
+
+
+def execute_run(run_number, seed):
+    print("Starting run " + str(run_number))
+    first_layer_instance = worker_state['first_layer_instance']
+    csv_export_recorder = worker_state['csv_export_recorder']
+    random.seed(seed)
+    np.random.seed(seed)
+    first_layer_instance.number_of_approximations = 0
+    if STEADY_STATE_EVOLUTION:
+        evaluation_executor = None
+        if STEADY_STATE_EVALUATION_WORKERS > 0:
+            evaluation_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=STEADY_STATE_EVALUATION_WORKERS, initializer=initialize_worker,
+                initargs=(first_layer_instance.pset, first_layer_instance.grid_points))
+        try:
+            best_overall_individual = gp_steady_state_evolution(0, None, ELITES_SIZE, POPULATION_SIZE,
+                                                                NUMBER_OF_EVALUATIONS, CROSSOVER_PROBABILITY,
+                                                                MUTATION_PROBABILITY, 0, first_layer_instance.toolbox,
+                                                                csv_export_recorder, 1, "approximation", None, 1,
+                                                                evaluation_executor, STEADY_STATE_EVALUATION_WORKERS,
+                                                                population_history=POPULATION_HISTORY)
+        finally:
+            if evaluation_executor is not None:
+                evaluation_executor.shutdown(cancel_futures=True)
+    else:
+        best_overall_individual = gp_evolution(0, None, ELITES_SIZE, POPULATION_SIZE, NUMBER_OF_GENERATIONS,
+                                               CROSSOVER_PROBABILITY, MUTATION_PROBABILITY, 0,
+                                               first_layer_instance.toolbox, csv_export_recorder, 1, "approximation",
+                                               None, 1, profile_generations=PROFILE_EVOLUTION,
+                                               population_history=POPULATION_HISTORY)
+    return (serialize_individuals([best_overall_individual]), first_layer_instance.number_of_approximations,
+            csv_export_recorder.take_calls())
+
+
+def get_number_of_run_workers():
+    # Every steady-state run keeps its own evaluation pool busy, so fewer runs are started at the same time
+    if STEADY_STATE_EVOLUTION and STEADY_STATE_EVALUATION_WORKERS > 0:
+        return max(1, (os.cpu_count() or 1) // STEADY_STATE_EVALUATION_WORKERS)
+    return None
 
 
 if __name__ == "__main__":
     try:
         now = datetime.now()
-        csvExporter = CsvExporter(now)
-        manager = multiprocessing.Manager()
+        csvExporter = CsvExporter(now, BUFFERED_CSV_EXPORT, EXPERIMENT_STORE)
         gp_first_layer_initializer = GpFirstLayerInitializer()
         gp_first_layer_initializer.initialize_gp_run()
         X, Y = np.meshgrid(X_RANGE, Y_RANGE)
         grid_points = np.column_stack((X.flatten(), Y.flatten()))
-        for run_number in range(NUMBER_OF_RUNS):
-            print("Starting run " + str(run_number))
-            first_layer_instance = FirstLayer(gp_first_layer_initializer.pset, grid_points, csvExporter)
-            first_layer_instance.initialize_toolbox()
-            best_overall_individual = gp_evolution(0, None, ELITES_SIZE, POPULATION_SIZE, NUMBER_OF_GENERATIONS,
-                                                   CROSSOVER_PROBABILITY, MUTATION_PROBABILITY, 0,
-                                                   first_layer_instance.toolbox, csvExporter, 1, "approximation", None, 1)
+        # The creator classes are needed in this process as well to receive the results
+        FirstLayer(gp_first_layer_initializer.pset, grid_points, csvExporter).initialize_toolbox()
+        for run_number, run_result in schedule_runs(execute_run, NUMBER_OF_RUNS, initialize_worker,
+                                                    (gp_first_layer_initializer.pset, grid_points),
+                                                    get_number_of_run_workers()):
+            serialized_best_individual, number_of_approximations, csv_export_calls = run_result
+            csvExporter.set_run_number(run_number)
+            replay_csv_export_calls(csv_export_calls, csvExporter)
+            best_overall_individual = deserialize_individuals(serialized_best_individual,
+                                                              gp_first_layer_initializer.pset)[0]
             if run_number == 0:
                 csvExporter.export_run_params_to_csv(first_layer_params, {})
             csvExporter.save_best_individual(best_overall_individual, run_number)
-            csvExporter.save_number_of_approximations(first_layer_instance.number_of_approximations, run_number)
+            csvExporter.save_number_of_approximations(number_of_approximations, run_number)
+            csvExporter.flush()
     except:
         traceback.print_exc()
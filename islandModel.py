@@ -0,0 +1,56 @@
+import queue
+import random
+
+from deap import tools
+
+from customLogic import serialize_individuals, deserialize_individuals
+
+RING_TOPOLOGY = "ring"
+RANDOM_TOPOLOGY = "random"
+
+
+class Migration:
+    # Connects one island (a gp_evolution process of the first layer) with the others. Every island owns an inbox
+    # queue, emigrants are sent to the inbox of the neighbour given by the topology and immigrants are taken without
+    # waiting, so islands that are not running at the same time never block each other.
+
+    def __init__(self, island_id, run_number, inboxes, pset, migration_interval, migration_size, topology):
+        self.island_id = island_id
+        self.run_number = run_number
+        self.inboxes = inboxes
+        self.pset = pset
+        self.migration_interval = migration_interval
+        self.migration_size = migration_size
+        self.topology = topology
+
+    def is_migration_generation(self, generation_number):
+        return (generation_number + 1) % self.migration_interval == 0
+
+    def exchange(self, population):
+        self.__emigrate(population)
+        return self.__immigrate()
+
+    def __emigrate(self, population):
+        if len(self.inboxes) < 2:
+            return
+        emigrants = tools.selBest(population, k=self.migration_size)
+        self.inboxes[self.__get_destination()].put((self.run_number, serialize_individuals(emigrants)))
+
+    def __get_destination(self):
+        if self.topology == RING_TOPOLOGY:
+            return (self.island_id + 1) % len(self.inboxes)
+        elif self.topology == RANDOM_TOPOLOGY:
+            destinations = [island_id for island_id in range(len(self.inboxes)) if island_id != self.island_id]
+            return random.choice(destinations)
+        raise ValueError(f"Unknown migration topology: {self.topology}")
+
+    def __immigrate(self):
+        immigrants = []
+        while True:
+            try:
+                run_number, serialized_individuals = self.inboxes[self.island_id].get_nowait()
+            except queue.Empty:
+                break
+            if run_number == self.run_number:  # leftovers from a previous run are dropped
+                immigrants += deserialize_individuals(serialized_individuals, self.pset)
+        return immigrants
@@ -1,5 +1,7 @@
 import math
 
+import numpy as np
+
 
 def protected_add(left, right):
     try:
@@ -50,5 +52,53 @@ def custom_if(x, y, z):
     else:
         return z
 
+# Array-aware versions of the primitives above, used when a whole grid is evaluated at once.
+# Invalid values are replaced for the whole batch instead of being reported one by one.
+def vectorized_protected_add(left, right):
+    result = np.add(left, right)
+    return np.where(np.isfinite(result), result, 1)
+
+
+def vectorized_sqrt(x):
+    return np.where(np.less(x, 0), 1, np.sqrt(np.abs(x)))
+
+
+def vectorized_sin(x):
+    return np.sin(x)
+
+
+def vectorized_pow2(x):
+    return np.multiply(x, x)
+
+
+def vectorized_pow3(x):
+    return np.multiply(np.multiply(x, x), x)
+
+
+VECTORIZED_PRIMITIVES = {
+    'protected_add': vectorized_protected_add,
+    'sqrt': vectorized_sqrt,
+    'sin': vectorized_sin,
+    'pow2': vectorized_pow2,
+    'pow3': vectorized_pow3,
+}
+
+# Bitwise versions of the boolean primitives. Every argument is an integer whose i-th bit holds the value of the
+# i-th input combination, so a single call evaluates all the combinations at once.
+def bitwise_and(x, y):
+    return x & y
+
+
+def bitwise_or(x, y):
+    return x | y
+
+
+def bitwise_not(x, full_mask):
+    return x ^ full_mask
+
+
+def bitwise_if(x, y, z, full_mask):
+    return (x & y) | ((x ^ full_mask) & z)
+
 # def avg(x):
 #     return round(x, 0)
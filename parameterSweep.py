@@ -0,0 +1,236 @@
+import concurrent.futures
+import itertools
+import math
+import random
+import shutil
+import sys
+import traceback
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+# The function approximation modules import each other from the functionApproximation folder
+sys.path.append(str(Path(__file__).resolve().parent / 'functionApproximation'))
+
+from booleanMultiplexer import firstLayerMultiplexer
+from booleanMultiplexer.gpBooleanMultiplexerInitialization import GpFirstLayerMUXInitializer, \
+    NUMBER_OF_RUNS as MUX_NUMBER_OF_RUNS
+from booleanMultiplexer.muxCustomLogic import BitParallelTruthTable, generate_all_possible_input_combinations
+from csvExport import CsvExporter
+from customLogic import is_solution_found
+from functionApproximation import firstLayer
+from functionApproximation.gpInitialization import GpFirstLayerInitializer, \
+    NUMBER_OF_RUNS as APPROXIMATION_NUMBER_OF_RUNS
+
+APPROXIMATION = "approximation"
+MUX = "MUX"
+# Every combination of the values is one configuration. The names are module constants of the first layer module,
+# names starting with SECOND_LAYER_PREFIX are class attributes of the second layer.
+PARAMETER_GRID = {
+    'POPULATION_SIZE': [50, 100, 200],
+    'NUMBER_OF_SUB_MODELS': [4, 8],
+    'MUTATION_PROBABILITY': [0.01, 0.05],
+}
+SECOND_LAYER_PREFIX = 'SECOND_LAYER_'
+MIN_RUNS_PER_CONFIGURATION = 5  # runs of every configuration in the first round
+# After every round only the best 1 / HALVING_RATE of the configurations are kept, and they get HALVING_RATE times
+# as many runs as in the round before
+HALVING_RATE = 2
+# The sub-models of a sweep run are evolved one after the other in the process of the run, so there are no islands,
+# and an interrupted sweep is started again instead of resumed
+SWEEP_OVERRIDES = {'ISLAND_MODEL': False, 'CHECKPOINT_INTERVAL': 0}
+PENDING_RUNS_FOLDER_NAME = 'pending_runs'
+
+
+def get_configurations(parameter_grid):
+    names = list(parameter_grid)
+    return [dict(zip(names, values)) for values in itertools.product(*parameter_grid.values())]
+
+
+def get_layers(problem_family):
+    if problem_family == APPROXIMATION:
+        return firstLayer, firstLayer.SecondLayer
+    if problem_family == MUX:
+        return firstLayerMultiplexer, firstLayerMultiplexer.SecondLayerMultiplexer
+    raise ValueError(f"Unknown problem family: {problem_family}")
+
+
+def get_parameter_value(problem_family, name):
+    layer_module, second_layer_class = get_layers(problem_family)
+    if name.startswith(SECOND_LAYER_PREFIX):
+        layer, attribute = second_layer_class, name[len(SECOND_LAYER_PREFIX):]
+    else:
+        layer, attribute = layer_module, name
+    if not hasattr(layer, attribute):
+        raise ValueError(f"Unknown parameter: {name}")
+    return getattr(layer, attribute)
+
+
+def complete_configurations(problem_family, configurations):
+    # Every configuration gets a value for every swept parameter, the current value if it does not set one, so a
+    # worker that ran another configuration before is reset
+    names = dict.fromkeys(name for configuration in configurations for name in configuration)
+    default_values = {name: get_parameter_value(problem_family, name) for name in names}
+    return [{**default_values, **configuration} for configuration in configurations]
+
+
+def apply_configuration(problem_family, configuration):
+    # Sets the parameters and the values in the params dicts, so the params csv files hold the configuration
+    layer_module, second_layer_class = get_layers(problem_family)
+    for name, value in {**configuration, **SWEEP_OVERRIDES}.items():
+        if name.startswith(SECOND_LAYER_PREFIX):
+            attribute = name[len(SECOND_LAYER_PREFIX):]
+            setattr(second_layer_class, attribute, value)
+            if attribute in second_layer_class.second_layer_params:
+                second_layer_class.second_layer_params[attribute] = value
+        else:
+            setattr(layer_module, name, value)
+            if name in layer_module.first_layer_params:
+                layer_module.first_layer_params[name] = value
+
+
+class ConfigurationResults:
+    # Best individual of every finished run of one configuration, the runs are saved in the folder of the
+    # configuration
+
+    def __init__(self, configuration_number, configuration, folder_name):
+        self.configuration_number = configuration_number
+        self.configuration = configuration
+        self.folder_name = folder_name
+        self.best_fitness_values = []
+        self.weighted_best_fitness_values = []  # the fitness times its weight, higher is better in both families
+        self.number_of_solutions = 0
+
+    def get_number_of_runs(self):
+        return len(self.best_fitness_values)
+
+    def add_run(self, best_fitness, weighted_best_fitness, solution_found):
+        self.best_fitness_values.append(best_fitness)
+        self.weighted_best_fitness_values.append(weighted_best_fitness)
+        if solution_found:
+            self.number_of_solutions += 1
+
+    def get_success_rate(self):
+        return self.number_of_solutions / self.get_number_of_runs()
+
+    def get_mean_best_fitness(self):
+        return float(np.mean(self.best_fitness_values))
+
+    def get_rank_key(self):
+        # The success rate decides first, the mean best fitness separates configurations that solve equally often
+        return self.get_success_rate(), float(np.mean(self.weighted_best_fitness_values))
+
+
+# State of a process in the sweep pool, loaded once by initialize_worker
+worker_state = {}
+
+
+def initialize_worker(problem_family):
+    worker_state['problem_family'] = problem_family
+    if problem_family == APPROXIMATION:
+        gp_first_layer_initializer = GpFirstLayerInitializer()
+        gp_first_layer_initializer.initialize_gp_run()
+        worker_state['grid_points'] = firstLayer.load_points_of_both_layers()
+    else:
+        gp_first_layer_initializer = GpFirstLayerMUXInitializer()
+        gp_first_layer_initializer.initialize_gp_run()
+        worker_state['full_truth_table'] = BitParallelTruthTable(generate_all_possible_input_combinations())
+    worker_state['pset'] = gp_first_layer_initializer.pset
+
+
+def execute_configuration_run(configuration, run_number, seed, run_folder_name):
+    # One run of both layers with the parameters of configuration, written to a folder of its own, returns the
+    # fitness of the best individual and whether it solves the problem
+    problem_family = worker_state['problem_family']
+    pset = worker_state['pset']
+    apply_configuration(problem_family, configuration)
+    random.seed(seed)
+    np.random.seed(seed)
+    csv_exporter = CsvExporter(None, folder_name=run_folder_name)
+    csv_exporter.set_run_number(run_number)
+    # The toolbox of the first layer is built again for every run, it depends on the configuration
+    if problem_family == APPROXIMATION:
+        firstLayer.initialize_worker(pset, worker_state['grid_points'], csv_exporter, None)
+        best_overall_individual = firstLayer.execute_run(run_number, pset, csv_exporter)
+    else:
+        firstLayerMultiplexer.initialize_worker(pset, csv_exporter, None)
+        best_overall_individual = firstLayerMultiplexer.execute_run(run_number, pset, worker_state['full_truth_table'],
+                                                                    csv_exporter)
+    solution_found = is_solution_found(best_overall_individual, problem_family, 2, 2, None)
+    return best_overall_individual.fitness.values[0], best_overall_individual.fitness.wvalues[0], solution_found
+
+
+def merge_run_folder(run_folder_name, folder_name):
+    # Appends the files of a run to the files of its configuration. The runs of a configuration are merged in run
+    # order, so the files are the same as those of an experiment that ran the configuration on its own.
+    for file_path in sorted(Path(run_folder_name).rglob('*')):
+        if file_path.is_file():
+            merged_file_path = Path(folder_name) / file_path.relative_to(run_folder_name)
+            merged_file_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(file_path, 'rb') as run_file, open(merged_file_path, 'ab') as merged_file:
+                shutil.copyfileobj(run_file, merged_file)
+    shutil.rmtree(run_folder_name)
+
+
+def execute_round(executor, configuration_results, number_of_runs, run_seeds):
+    # Brings every configuration up to number_of_runs runs. The runs of all configurations are spread over the pool,
+    # run i of every configuration starts from the same seed.
+    futures = {}
+    for results in configuration_results:
+        for run_number in range(results.get_number_of_runs(), number_of_runs):
+            run_folder_name = Path(results.folder_name) / PENDING_RUNS_FOLDER_NAME / str(run_number)
+            futures[results.configuration_number, run_number] = executor.submit(
+                execute_configuration_run, results.configuration, run_number, run_seeds[run_number], run_folder_name)
+    for results in configuration_results:
+        for run_number in range(results.get_number_of_runs(), number_of_runs):
+            results.add_run(*futures[results.configuration_number, run_number].result())
+            merge_run_folder(Path(results.folder_name) / PENDING_RUNS_FOLDER_NAME / str(run_number),
+                             results.folder_name)
+        shutil.rmtree(Path(results.folder_name) / PENDING_RUNS_FOLDER_NAME, ignore_errors=True)
+
+
+def sweep(problem_family, parameter_grid, csv_exporter, max_runs_per_configuration, max_workers=None):
+    # Successive halving: every configuration starts with MIN_RUNS_PER_CONFIGURATION runs, the worse half is dropped
+    # after every round and the rest get twice the runs, until one configuration is left or the kept ones reached
+    # max_runs_per_configuration. Returns the results of the configurations of the last round, best first.
+    configurations = complete_configurations(problem_family, get_configurations(parameter_grid))
+    configuration_results = [ConfigurationResults(i, configuration,
+                                                  Path(csv_exporter.folder_name) / f'configuration_{i}')
+                             for i, configuration in enumerate(configurations)]
+    run_seeds = [random.randrange(2 ** 32) for _ in range(max_runs_per_configuration)]
+    number_of_runs = min(MIN_RUNS_PER_CONFIGURATION, max_runs_per_configuration)
+    round_number = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=initialize_worker,
+                                                initargs=(problem_family,)) as executor:
+        while True:
+            print(f"Round {round_number}: {len(configuration_results)} configurations with {number_of_runs} runs")
+            execute_round(executor, configuration_results, number_of_runs, run_seeds)
+            configuration_results.sort(key=ConfigurationResults.get_rank_key, reverse=True)
+            last_round = len(configuration_results) == 1 or number_of_runs == max_runs_per_configuration
+            number_of_kept_configurations = (len(configuration_results) if last_round else
+                                             math.ceil(len(configuration_results) / HALVING_RATE))
+            csv_exporter.save_sweep_round(round_number, configuration_results, number_of_kept_configurations)
+            csv_exporter.flush()
+            for rank, results in enumerate(configuration_results):
+                print(f"Configuration {results.configuration_number} {results.configuration}: success rate "
+                      f"{results.get_success_rate()}, mean best fitness {results.get_mean_best_fitness()}"
+                      f"{'' if rank < number_of_kept_configurations else ', dropped'}")
+            if last_round:
+                return configuration_results
+            configuration_results = configuration_results[:number_of_kept_configurations]
+            number_of_runs = min(number_of_runs * HALVING_RATE, max_runs_per_configuration)
+            round_number += 1
+
+
+if __name__ == "__main__":
+    # Usage: python parameterSweep.py approximation|MUX, sweeps PARAMETER_GRID with up to NUMBER_OF_RUNS runs of a
+    # configuration, every configuration is saved in a configuration_<number> folder of the experiment
+    try:
+        family = sys.argv[1] if len(sys.argv) > 1 else APPROXIMATION
+        max_runs = APPROXIMATION_NUMBER_OF_RUNS if family == APPROXIMATION else MUX_NUMBER_OF_RUNS
+        sweep_csv_exporter = CsvExporter(datetime.now())
+        best_configurations = sweep(family, PARAMETER_GRID, sweep_csv_exporter, max_runs)
+        print(f"Best configuration: {best_configurations[0].configuration}")
+    except:
+        traceback.print_exc()
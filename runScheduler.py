@@ -0,0 +1,41 @@
+import concurrent.futures
+import random
+
+
+class CsvExportRecorder:
+    # Stands in for the CsvExporter inside a scheduled run. Runs finish in any order, so their exports are recorded
+    # and replayed by the parent process in run order to keep the csv files the same as with sequential runs.
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        def record(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+
+        return record
+
+    def take_calls(self):
+        calls = self.calls
+        self.calls = []
+        return calls
+
+
+def replay_csv_export_calls(calls, csv_exporter):
+    for name, args, kwargs in calls:
+        getattr(csv_exporter, name)(*args, **kwargs)
+
+
+def schedule_runs(run_function, number_of_runs, initializer=None, initargs=(), max_workers=None):
+    # Spreads independent runs over all cores. Every run gets its own seed, called as run_function(run_number, seed),
+    # and the results are yielded in run order as soon as all the previous runs are done.
+    seeds = [random.randrange(2 ** 32) for _ in range(number_of_runs)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=initializer,
+                                                initargs=initargs) as executor:
+        futures = [executor.submit(run_function, run_number, seeds[run_number]) for run_number in
+                   range(number_of_runs)]
+        for run_number, future in enumerate(futures):
+            yield run_number, future.result()
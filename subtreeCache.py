@@ -0,0 +1,93 @@
+import sys
+import threading
+from collections import OrderedDict
+
+from deap import gp
+
+
+def get_subtree_keys_and_ends(individual):
+    # Walk the prefix notation backwards so that the end of every subtree is known before its parent.
+    # A key is the sequence of node names of the subtree, the same structural key as get_structural_key, so only
+    # structurally identical subtrees share it and two different subtrees never collide.
+    names = [node.name for node in individual]
+    keys = [None] * len(individual)
+    ends = [0] * len(individual)
+    stack = []
+    for index in range(len(individual) - 1, -1, -1):
+        end = index + 1
+        for _ in range(individual[index].arity):
+            end = stack.pop()
+        keys[index] = tuple(names[index:end])
+        ends[index] = end
+        stack.append(end)
+    return keys, ends
+
+
+class SubtreeCache:
+    # Keeps the output (grid vector or truth table mask) of every evaluated subtree, evicting the least recently used
+    # ones once the total size of the outputs and their keys exceeds max_bytes. Offspring mostly consist of subtrees
+    # of their parents, so only the nodes on the path from the changed subtree to the root have to be computed again.
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.outputs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # evaluations can run in threads of the steady-state evolution
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.outputs.clear()
+            self.current_bytes = 0
+
+    def evaluate(self, individual, context):
+        # context maps primitive names to their implementations and argument names to their values
+        keys, ends = get_subtree_keys_and_ends(individual)
+        output, _ = self.__evaluate_node(individual, 0, keys, ends, context)
+        return output
+
+    def __evaluate_node(self, individual, index, keys, ends, context):
+        node = individual[index]
+        if isinstance(node, gp.Terminal):
+            if isinstance(node.value, str):
+                return context[node.value], index + 1
+            return node.value, index + 1
+        key = keys[index]
+        with self.lock:
+            output = self.outputs.get(key)
+            if output is not None:
+                self.hits += 1
+                self.outputs.move_to_end(key)
+                return output, ends[index]
+            self.misses += 1
+        arguments = []
+        child_index = index + 1
+        for _ in range(node.arity):
+            child_output, child_index = self.__evaluate_node(individual, child_index, keys, ends, context)
+            arguments.append(child_output)
+        output = context[node.name](*arguments)
+        self.__store(key, output)
+        return output, child_index
+
+    def __store(self, key, output):
+        size = sys.getsizeof(output) + sys.getsizeof(key)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.outputs:  # another thread was faster
+                return
+            self.outputs[key] = output
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                evicted_key, evicted_output = self.outputs.popitem(last=False)
+                self.current_bytes -= sys.getsizeof(evicted_output) + sys.getsizeof(evicted_key)
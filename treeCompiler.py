@@ -0,0 +1,114 @@
+import threading
+from collections import OrderedDict
+
+from deap import gp
+
+COMPILE_CACHE_SIZE = 4096  # number of compiled trees kept per compiler, 0 disables the cache
+
+
+def get_structural_key(individual):
+    # The prefix notation of a tree is unambiguous because the arity of every node is fixed by the primitive set
+    return tuple(node.name for node in individual)
+
+
+def compile_tree(individual, context, arguments):
+    # Same result as gp.compile, but the function is put together from closures over the nodes instead of generating
+    # and parsing source text, so there is no parser cost and no limit of 90 on the tree height.
+    # context maps primitive names to their implementations, arguments are the names of the function arguments.
+    argument_indices = {name: index for index, name in enumerate(arguments)}
+    stack = []
+    for node in reversed(individual):  # the children of a node are built before the node itself
+        if isinstance(node, gp.Terminal):
+            if isinstance(node.value, str) and node.value in argument_indices:
+                stack.append(get_argument_closure(argument_indices[node.value]))
+            elif isinstance(node.value, str):
+                stack.append(get_constant_closure(context[node.value]))
+            else:
+                stack.append(get_constant_closure(node.value))
+        else:
+            children = [stack.pop() for _ in range(node.arity)]
+            stack.append(get_primitive_closure(context[node.name], children))
+    root = stack.pop()
+    return lambda *argument_values: root(argument_values)
+
+
+def compile_source(individual, context, arguments):
+    # gp.compile without the primitive set. Functions that are called once per point run faster as generated source
+    # than as nested closures, trees that are too high for the parser are still compiled with compile_tree.
+    try:
+        return eval("lambda {args}: {code}".format(args=",".join(arguments), code=str(individual)), context, {})
+    except (SyntaxError, MemoryError, RecursionError):
+        return compile_tree(individual, context, arguments)
+
+
+def get_argument_closure(index):
+    return lambda argument_values: argument_values[index]
+
+
+def get_constant_closure(value):
+    return lambda argument_values: value
+
+
+def get_primitive_closure(primitive, children):
+    # The common arities get their own closure so that the children are called without building a list
+    if len(children) == 1:
+        first, = children
+        return lambda argument_values: primitive(first(argument_values))
+    if len(children) == 2:
+        first, second = children
+        return lambda argument_values: primitive(first(argument_values), second(argument_values))
+    if len(children) == 3:
+        first, second, third = children
+        return lambda argument_values: primitive(first(argument_values), second(argument_values),
+                                                 third(argument_values))
+    return lambda argument_values: primitive(*[child(argument_values) for child in children])
+
+
+class TreeCompiler:
+    # Compiles trees with compile_tree and keeps the functions of the most recently used tree structures, so elites
+    # and unchanged clones are not compiled again. One compiler belongs to one primitive set and one context (scalar,
+    # vectorized or bitwise primitives), the terminals are looked up by name. Compilers of functions that are called
+    # for every point use compile_source instead.
+
+    def __init__(self, context, arguments, max_entries=COMPILE_CACHE_SIZE, called_per_point=False):
+        self.context = context
+        self.arguments = list(arguments)
+        self.max_entries = max_entries
+        self.compile_function = compile_source if called_per_point else compile_tree
+        self.functions = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # evaluations can run in threads of the steady-state evolution
+
+    def __getstate__(self):
+        # The closures cannot be pickled, a worker process starts with an empty cache
+        state = self.__dict__.copy()
+        del state['lock']
+        state['functions'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.functions.clear()
+
+    def compile(self, individual):
+        if self.max_entries <= 0:
+            return self.compile_function(individual, self.context, self.arguments)
+        key = get_structural_key(individual)
+        with self.lock:
+            function = self.functions.get(key)
+            if function is not None:
+                self.hits += 1
+                self.functions.move_to_end(key)
+                return function
+            self.misses += 1
+        function = self.compile_function(individual, self.context, self.arguments)
+        with self.lock:
+            self.functions[key] = function
+            if len(self.functions) > self.max_entries:
+                self.functions.popitem(last=False)
+        return function
@@ -0,0 +1,118 @@
+import math
+
+from deap import gp
+
+# Rewrites that keep the output of a tree for every finite input. sub(e, e) and protected_add(e, 0.0) also hold for
+# finite subtree outputs only: a subtree that overflows to inf is replaced by a finite value.
+
+
+def is_constant(nodes):
+    return len(nodes) == 1 and isinstance(nodes[0], gp.Terminal) and type(nodes[0].value) is float
+
+
+def is_constant_value(nodes, value):
+    return is_constant(nodes) and nodes[0].value == value
+
+
+def get_names(nodes):
+    return tuple(node.name for node in nodes)
+
+
+def get_constant_terminal(value, pset):
+    # Reuse the terminal of the primitive set if there is one, otherwise the constant gets its own terminal, which
+    # str() and gp.PrimitiveTree.from_string handle like any other constant
+    terminal = pset.mapping.get(str(value))
+    if terminal is not None and isinstance(terminal, gp.Terminal) and terminal.value == value:
+        return terminal
+    return gp.Terminal(value, False, pset.ret)
+
+
+def fold_constants(primitive, children, pset):
+    try:
+        value = pset.context[primitive.name](*(child[0].value for child in children))
+    except (ArithmeticError, ValueError):
+        return None
+    if type(value) is not float or not math.isfinite(value):
+        return None
+    return [get_constant_terminal(value, pset)]
+
+
+def simplify_primitive(primitive, children, pset):
+    # Returns the simplified nodes of the subtree whose root is primitive, or None to keep the subtree as it is
+    if all(is_constant(child) for child in children):
+        return fold_constants(primitive, children, pset)
+    name = primitive.name
+    if name == 'mul':
+        if is_constant_value(children[0], 1.0):
+            return children[1]
+        if is_constant_value(children[1], 1.0):
+            return children[0]
+    elif name == 'protected_add':
+        if is_constant_value(children[0], 0.0):
+            return children[1]
+        if is_constant_value(children[1], 0.0):
+            return children[0]
+    elif name == 'sub':
+        if is_constant_value(children[1], 0.0):
+            return children[0]
+        if get_names(children[0]) == get_names(children[1]):
+            return [get_constant_terminal(0.0, pset)]
+    elif name == 'custom_not':
+        if children[0][0].name == 'custom_not':
+            return children[0][1:]
+    elif name in ('custom_and', 'custom_or'):
+        if get_names(children[0]) == get_names(children[1]):
+            return children[0]
+    elif name == 'custom_if':
+        condition, if_true, if_false = children
+        if get_names(if_true) == get_names(if_false):
+            return if_true
+        if get_names(condition) == get_names(if_true) and 'custom_or' in pset.mapping:
+            return [pset.mapping['custom_or']] + condition + if_false
+        if get_names(condition) == get_names(if_false) and 'custom_and' in pset.mapping:
+            return [pset.mapping['custom_and']] + condition + if_true
+        if condition[0].name == 'custom_not':
+            return [primitive] + condition[1:] + if_false + if_true
+    return None
+
+
+def simplify_individual(individual, pset):
+    # Returns the individual itself if nothing can be simplified, otherwise a new tree of the same class. The nodes
+    # are visited backwards, so the children of a node are already simplified when the node is reached.
+    stack = []
+    changed = False
+    for node in reversed(individual):
+        if isinstance(node, gp.Terminal):
+            stack.append([node])
+            continue
+        children = [stack.pop() for _ in range(node.arity)]
+        nodes = simplify_primitive(node, children, pset)
+        if nodes is None:
+            stack.append([node] + [child_node for child in children for child_node in child])
+            continue
+        changed = True
+        # the new root can allow another rewrite, e.g. custom_if(custom_not(a), b, a) becomes custom_if(a, a, b)
+        while not isinstance(nodes[0], gp.Terminal):
+            simplified_nodes = simplify_primitive(nodes[0], split_children(nodes), pset)
+            if simplified_nodes is None:
+                break
+            nodes = simplified_nodes
+        stack.append(nodes)
+    if not changed:
+        return individual
+    return type(individual)(stack.pop())
+
+
+def split_children(nodes):
+    # Splits the nodes below the root of a subtree into the node lists of its children
+    children = []
+    index = 1
+    while index < len(nodes):
+        end = index
+        open_subtrees = 1
+        while open_subtrees > 0:
+            open_subtrees += nodes[end].arity - 1
+            end += 1
+        children.append(nodes[index:end])
+        index = end
+    return children
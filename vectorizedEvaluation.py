@@ -0,0 +1,65 @@
+import numpy as np
+
+from methodDefinitions import VECTORIZED_PRIMITIVES
+from treeCompiler import compile_tree
+
+
+def get_vectorized_context(pset, argument_values=()):
+    context = dict(pset.context)
+    for name, primitive in VECTORIZED_PRIMITIVES.items():
+        if name in context:
+            context[name] = primitive
+    context.update(zip(pset.arguments, argument_values))
+    return context
+
+
+def compile_vectorized(expr, pset):
+    # Same as gp.compile, but the primitives are swapped for their array-aware versions so that the
+    # compiled function can be called once with the whole grid instead of once per point
+    return compile_tree(expr, get_vectorized_context(pset), pset.arguments)
+
+
+def compute_output_vector(expr, pset, x_values, y_values):
+    # Output of a tree for every point, used to turn first layer sub-models into second layer terminals
+    with np.errstate(all='ignore'):
+        individual_output = compile_vectorized(expr, pset)(x_values, y_values)
+    return np.array(np.broadcast_to(individual_output, np.shape(x_values)), dtype=float)
+
+
+def evaluate_mse_vectorized(function, x_values, y_values, target_values):
+    with np.errstate(all='ignore'):
+        return mean_squared_error(function(x_values, y_values), target_values)
+
+
+def evaluate_mse_with_subtree_cache(subtree_cache, individual, context, target_values):
+    with np.errstate(all='ignore'):
+        return mean_squared_error(subtree_cache.evaluate(individual, context), target_values)
+
+
+def get_squared_error_sum_in_chunks(function, chunks):
+    # chunks yields x values, y values and target values, only one chunk of points is in memory at a time. Returns
+    # the sum of the squared errors and the number of points.
+    squared_error_sum = 0.0
+    number_of_points = 0
+    with np.errstate(all='ignore'):
+        for x_values, y_values, target_values in chunks:
+            squared_error_sum += float(np.sum(np.square(target_values - function(x_values, y_values))))
+            number_of_points += len(target_values)
+    return squared_error_sum, number_of_points
+
+
+def evaluate_mse_in_chunks(function, chunks):
+    squared_error_sum, number_of_points = get_squared_error_sum_in_chunks(function, chunks)
+    total_error = squared_error_sum / number_of_points
+    if np.isnan(total_error):
+        return float('inf')
+    return total_error
+
+
+def mean_squared_error(individual_output, target_values):
+    with np.errstate(all='ignore'):
+        # constant trees return a scalar, broadcasting takes care of it
+        total_error = float(np.mean(np.square(target_values - individual_output)))
+    if np.isnan(total_error):
+        return float('inf')
+    return total_error